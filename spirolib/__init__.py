@@ -3,17 +3,71 @@
 A library to perform various operations on spirometry data
 """
 
-from .spiro_signal_process import spiro_signal_process
-from .spiro_features_extraction import spiro_features_extraction
-from .spiro_features_lite import spiro_features_lite
-from .spiro_batch_process import spiro_trialsbatch_process, spiro_batch_process
-from .utilities import utilities
+import importlib
+import sys
+import types
+
+__version__ = '0.1.0'
+
+# Submodules are imported on first access of one of their classes so that
+# "import spirolib" does not pull in matplotlib, scipy or pandas
+_submodules = {
+    'spiro_signal_process': 'spiro_signal_process',
+    'spiro_signal_batch': 'spiro_signal_batch',
+    'spiro_signal_store': 'spiro_signal_batch',
+    'spiro_features_extraction': 'spiro_features_extraction',
+    'spiro_features_lite': 'spiro_features_lite',
+    'spiro_trialsbatch_process': 'spiro_batch_process',
+    'spiro_cohort_trials_process': 'spiro_batch_process',
+    'spiro_trial_bank': 'spiro_batch_process',
+    'spiro_batch_process': 'spiro_batch_process',
+    'spiro_cohort_process': 'spiro_batch_process',
+    'utilities': 'utilities',
+    'result_cache': 'utilities',
+    'balloon_lut': 'utilities',
+    'fit_budget': 'utilities',
+    'fit_history': 'utilities'
+}
 
 __all__ = [
     'spiro_signal_process',
+    'spiro_signal_batch',
+    'spiro_signal_store',
     'spiro_features_extraction',
     'spiro_features_lite',
     'spiro_trialsbatch_process',
+    'spiro_cohort_trials_process',
+    'spiro_trial_bank',
     'spiro_batch_process',
-    'utilities'
-]
\ No newline at end of file
+    'spiro_cohort_process',
+    'utilities',
+    'result_cache',
+    'balloon_lut',
+    'fit_budget',
+    'fit_history'
+]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        module = importlib.import_module('.' + _submodules[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'spirolib' has no attribute " + repr(name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _package(types.ModuleType):
+    # Importing a submodule binds it on the package under its own name, which
+    # would hide the class of the same name (e.g. spirolib.utilities)
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and name in _submodules and hasattr(value, name):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _package
@@ -14,7 +14,8 @@ class spiro_trialsbatch_process:
     def  __init__(self,TrialsBatch):                     
         self.TrialsBatch=TrialsBatch
     
-    def check_between_manoeuvre_criteria(self):
+    def check_between_manoeuvre_criteria(self, tolerance=0.2):
+        # tolerance: maximum difference (L) between the two highest FEV1s and FVCs
         TrialDict=self.TrialsBatch
         n_trials=len(TrialDict)
         
@@ -40,7 +41,7 @@ class spiro_trialsbatch_process:
             
             diff_highest_FEV1s=abs(highest_FEV1s[0]-highest_FEV1s[1])
             diff_highest_FVCs=abs(highest_FVCs[0]-highest_FVCs[1])
-            if diff_highest_FEV1s<=0.2 and diff_highest_FVCs<=0.2:
+            if diff_highest_FEV1s<=tolerance and diff_highest_FVCs<=tolerance:
                 return True
             else:
                 return False
@@ -61,6 +62,147 @@ class spiro_trialsbatch_process:
             best_trialID=max(FVL_sum, key=FVL_sum.get)
             return best_trialID   
 
+class spiro_trial_bank:
+    # Incremental version of spiro_trialsbatch_process for trials that arrive one at a time
+    # (one bank per patient and session). Keeps the two highest FEV1s and FVCs and the trial
+    # with the highest FEV1+FVC, so that check_between_manoeuvre_criteria and select_best_trial
+    # do not loop over the trials. Removing one of these trials rescans the remaining trials
+    def __init__(self):
+        self.trials={} # {trialID: (FEV1, FVC)} in order of arrival
+        self.rescan()
+
+    def __len__(self):
+        return len(self.trials)
+
+    def add_trial(self, trialID, sp=None, FEV1=None, FVC=None):
+        # Adds a finalized spiro_signal_process object sp, or FEV1 and FVC values
+        if sp is not None:
+            FEV1, FVC = sp.FEV1, sp.FVC
+        if trialID in self.trials:
+            # replaced trial keeps its position, as in a dictionary
+            self.trials[trialID]=(FEV1, FVC)
+            self.rescan()
+            return
+        self.trials[trialID]=(FEV1, FVC)
+        self.top_FEV1=self.push_top2(self.top_FEV1, FEV1, trialID)
+        self.top_FVC=self.push_top2(self.top_FVC, FVC, trialID)
+        if self.best_trialID is None or FEV1+FVC>self.best_sum:
+            self.best_trialID, self.best_sum = trialID, FEV1+FVC
+
+    def remove_trial(self, trialID):
+        del self.trials[trialID]
+        tracked=[t for _, t in self.top_FEV1]+[t for _, t in self.top_FVC]+[self.best_trialID]
+        if trialID in tracked:
+            self.rescan()
+
+    def push_top2(self, top, value, trialID):
+        # top: up to two (value, trialID) pairs, highest first
+        if len(top)==0 or value>top[0][0]:
+            return [(value, trialID)]+top[:1]
+        if len(top)==1 or value>top[1][0]:
+            return [top[0], (value, trialID)]
+        return top
+
+    def rescan(self):
+        self.top_FEV1, self.top_FVC = [], []
+        self.best_trialID, self.best_sum = None, None
+        for trialID, (FEV1, FVC) in self.trials.items():
+            self.top_FEV1=self.push_top2(self.top_FEV1, FEV1, trialID)
+            self.top_FVC=self.push_top2(self.top_FVC, FVC, trialID)
+            if self.best_trialID is None or FEV1+FVC>self.best_sum:
+                self.best_trialID, self.best_sum = trialID, FEV1+FVC
+
+    def check_between_manoeuvre_criteria(self, tolerance=0.2):
+        # Same return values as spiro_trialsbatch_process.check_between_manoeuvre_criteria
+        if len(self.trials)==0:
+            raise Exception('No trials found')
+        if len(self.trials)==1:
+            return "Only 1 trial found"
+        diff_highest_FEV1s=abs(self.top_FEV1[0][0]-self.top_FEV1[1][0])
+        diff_highest_FVCs=abs(self.top_FVC[0][0]-self.top_FVC[1][0])
+        if diff_highest_FEV1s<=tolerance and diff_highest_FVCs<=tolerance:
+            return True
+        else:
+            return False
+
+    def select_best_trial(self):
+        # Same return value as spiro_trialsbatch_process.select_best_trial
+        if len(self.trials)==0:
+            raise Exception('No trials found')
+        return self.best_trialID
+
+class spiro_cohort_trials_process:
+    # Cohort-level version of spiro_trialsbatch_process. Input is a long dataframe with one row
+    # per trial and columns patientID, trialID, FEV1 and FVC, plus optionally a column that
+    # separates the sessions of a patient (e.g. pre/post). spiro_signal_batch.to_dataframe()
+    # has this layout. All patients are handled at once with sorts over the whole table
+    def __init__(self, df_trials, patientID_col='patientID', trialID_col='trialID',
+                 session_col=None, FEV1_col='FEV1', FVC_col='FVC'):
+        self.df_trials=df_trials
+        self.patientID_col=patientID_col
+        self.trialID_col=trialID_col
+        self.session_col=session_col
+        self.FEV1_col=FEV1_col
+        self.FVC_col=FVC_col
+
+    def get_groups(self):
+        # Group code of every trial and the index (patientID or (patientID, session)) of the groups
+        import pandas as pd
+        keys=[self.patientID_col] if self.session_col is None else [self.patientID_col, self.session_col]
+        codes, groups = pd.MultiIndex.from_frame(self.df_trials[keys]).factorize()
+        if self.session_col is None:
+            groups=pd.Index(groups.get_level_values(0), name=self.patientID_col)
+        else:
+            groups.names=keys
+        return codes, groups
+
+    def get_top2(self, values, codes, n_groups):
+        # Highest and second highest value of each group (NaN if the group has one trial)
+        import numpy as np
+        order=np.lexsort((-values, codes))
+        first=np.searchsorted(codes[order], np.arange(n_groups))
+        counts=np.bincount(codes, minlength=n_groups)
+        top1=values[order[first]]
+        top2=np.full(n_groups, np.nan)
+        top2[counts>1]=values[order[first[counts>1]+1]]
+        return top1, top2, counts
+
+    def check_between_manoeuvre_criteria(self, tolerance=0.2):
+        '''
+        Between-manoeuvre repeatability of every patient (and session)
+        Inputs:
+        1. tolerance: maximum difference (L) between the two highest FEV1s and FVCs
+        Returns a dataframe with the number of trials, the differences between the two highest
+        FEV1s and FVCs and the repeatability flag (<NA> when only 1 trial is found, as
+        spiro_trialsbatch_process returns "Only 1 trial found")
+        '''
+        import numpy as np
+        import pandas as pd
+        codes, groups = self.get_groups()
+        FEV1=self.df_trials[self.FEV1_col].to_numpy(dtype=float)
+        FVC=self.df_trials[self.FVC_col].to_numpy(dtype=float)
+        FEV1_top1, FEV1_top2, counts = self.get_top2(FEV1, codes, len(groups))
+        FVC_top1, FVC_top2, _ = self.get_top2(FVC, codes, len(groups))
+        
+        diff_FEV1=np.abs(FEV1_top1-FEV1_top2)
+        diff_FVC=np.abs(FVC_top1-FVC_top2)
+        repeatable=pd.array((diff_FEV1<=tolerance) & (diff_FVC<=tolerance), dtype="boolean")
+        repeatable[counts==1]=pd.NA
+        return pd.DataFrame({'n_trials':counts, 'diff_highest_FEV1s':diff_FEV1,
+                             'diff_highest_FVCs':diff_FVC, 'repeatable':repeatable}, index=groups)
+
+    def select_best_trial(self):
+        # Trial with the highest FEV1+FVC of every patient (and session); on ties the
+        # first trial in table order, as spiro_trialsbatch_process.select_best_trial
+        import numpy as np
+        import pandas as pd
+        codes, groups = self.get_groups()
+        FVL_sum=self.df_trials[self.FEV1_col].to_numpy(dtype=float)+self.df_trials[self.FVC_col].to_numpy(dtype=float)
+        order=np.lexsort((np.arange(len(codes)), -FVL_sum, codes))
+        first=np.searchsorted(codes[order], np.arange(len(groups)))
+        best=self.df_trials[self.trialID_col].to_numpy()[order[first]]
+        return pd.Series(best, index=groups, name='best_trialID')
+
 class spiro_batch_process:
     # Input is an existing dataframe with patient ids as index, a dictionary BestFVL 
     # that is formatted as {patientID: sp} where patientID and dataframe index are the same 
@@ -70,76 +212,177 @@ class spiro_batch_process:
         self.pre_post_str=pre_post_str
         #self.add_features=add_features
         
-    def update_raw_parameters(self):
+    def update_raw_parameters(self, dtype="float64"):
+        '''
+        Adds the spirometry parameters of BestFVL as "<pre_post_str><parameter>_raw" columns
+        to df_main and returns the updated dataframe. Patients without data get NaN (not "")
+        and the columns are numeric. The columns are joined into a new dataframe that replaces
+        self.df_main, the dataframe passed to __init__ is not modified
+        BestFVL can also be a spiro_signal_batch (one row per patient ID, last trial wins)
+        Inputs:
+        1. dtype: dtype of the new columns ("float64" or "float32")
+        '''
+        import numpy as np
+        import pandas as pd
         df=self.df_main
         BestFVL=self.BestFVL
         label=self.pre_post_str
         
-        # define column names
-        FEV1_str=label+"FEV1"+"_raw"
-        FVC_str=label+"FVC"+"_raw"
-        FEV1_FVC_str=label+"FEV1_FVC"+"_raw"
-        PEF_str=label+"PEF"+"_raw"
-        FEF25_str=label+"FEF25"+"_raw"
-        FEF50_str=label+"FEF50"+"_raw"
-        FEF75_str=label+"FEF75"+"_raw"
-        FEF25_75_str=label+"FEF25_75"+"_raw"
-        
-        FEV1_PerPred_str=label+"FEV1_PerPred"+"_raw"
-        FVC_PerPred_str=label+"FVC_PerPred"+"_raw"
-        FEV1_FVC_PerPred_str=label+"FEV1_FVC_PerPred"+"_raw"
-        PEF_PerPred_str=label+"PEF_PerPred"+"_raw"
-        FEF25_PerPred_str=label+"FEF25_PerPred"+"_raw"
-        FEF50_PerPred_str=label+"FEF50_PerPred"+"_raw"
-        FEF75_PerPred_str=label+"FEF75_PerPred"+"_raw"
-        FEF25_75_PerPred_str=label+"FEF25_75_PerPred"+"_raw"
-        
-        
-        
-        #Initialize columns to null
-        df[FVC_str]=""
-        df[FEV1_str]=""
-        df[FEV1_FVC_str]=""
-        df[PEF_str]=""
-        df[FEF25_str]=""
-        df[FEF50_str]=""
-        df[FEF75_str]=""
-        df[FEF25_75_str]=""
+        # column names and the spiro_signal_process attribute they are read from
+        params=[("FVC","FVC"), ("FEV1","FEV1"), ("FEV1_FVC","Tiff"), ("PEF","PEF"),
+                ("FEF25","FEF25"), ("FEF50","FEF50"), ("FEF75","FEF75"), ("FEF25_75","FEF25_75"),
+                ("FEV1_PerPred","FEV1_PerPred"), ("FVC_PerPred","FVC_PerPred"),
+                ("FEV1_FVC_PerPred","Tiff_PerPred"), ("PEF_PerPred","PEF_PerPred"),
+                ("FEF25_PerPred","FEF25_PerPred"), ("FEF50_PerPred","FEF50_PerPred"),
+                ("FEF75_PerPred","FEF75_PerPred"), ("FEF25_75_PerPred","FEF25_75_PerPred")]
+        col_names=[label+name+"_raw" for name, _ in params]
         
-        df[FEV1_PerPred_str]=""
-        df[FVC_PerPred_str]=""
-        df[FEV1_FVC_PerPred_str]=""
-        df[PEF_PerPred_str]=""
-        df[FEF25_PerPred_str]=""
-        df[FEF50_PerPred_str]=""
-        df[FEF75_PerPred_str]=""
-        df[FEF25_75_PerPred_str]=""
+        # Build the whole block at once
+        if isinstance(BestFVL, dict):
+            patIDs=list(BestFVL)
+            values=np.array([[getattr(BestFVL[patID], attr, np.nan) for _, attr in params]
+                             for patID in patIDs], dtype=float).reshape(len(patIDs), len(params))
+        else:
+            patIDs=list(BestFVL.patientID)
+            values=np.column_stack([BestFVL.columns[attr] for _, attr in params])
+        block=pd.DataFrame(values, index=pd.Index(patIDs), columns=col_names).astype(dtype)
+        block=block[~block.index.duplicated(keep='last')]
         
-        #
-  
-        # Update values
-        for patID in BestFVL:
-            if patID in df.index:
-                sp=BestFVL[patID]
-                df.loc[patID,FVC_str]=sp.FVC
-                df.loc[patID,FEV1_str]=sp.FEV1
-                df.loc[patID,FEV1_FVC_str]=sp.Tiff
-                df.loc[patID,PEF_str]=sp.PEF
-                df.loc[patID,FEF25_str]=sp.FEF25
-                df.loc[patID,FEF50_str]=sp.FEF50
-                df.loc[patID,FEF75_str]=sp.FEF75
-                df.loc[patID,FEF25_75_str]=sp.FEF25_75
-                
-                df.loc[patID,FVC_PerPred_str]=sp.FVC_PerPred
-                df.loc[patID,FEV1_PerPred_str]=sp.FEV1_PerPred
-                df.loc[patID,FEV1_FVC_PerPred_str]=sp.Tiff_PerPred
-                df.loc[patID,PEF_PerPred_str]=sp.PEF_PerPred
-                df.loc[patID,FEF25_PerPred_str]=sp.FEF25_PerPred
-                df.loc[patID,FEF50_PerPred_str]=sp.FEF50_PerPred
-                df.loc[patID,FEF75_PerPred_str]=sp.FEF75_PerPred
-                df.loc[patID,FEF25_75_PerPred_str]=sp.FEF25_75_PerPred
-            else:
-                print("WARNING: Raw data ID "+patID+" not found in dataset")
-            
+        found=block.index.isin(df.index)
+        if not np.all(found):
+            missing=list(block.index[~found])
+            print("WARNING: "+str(len(missing))+" raw data IDs not found in dataset: "+", ".join(map(str, missing)))
         
-        return df
\ No newline at end of file
+        df=df.drop(columns=col_names, errors='ignore').join(block[found])
+        self.df_main=df
+        return df
+
+class spiro_cohort_process:
+    # Input is a dictionary FVLData formatted as {patientID: [Time, Volume, Flow]} (the unprocessed
+    # layout used in examples/process_spiro_data.py) and an optional dictionary Clinical formatted as
+    # {patientID: (sex, age, height)} used for the ECCS93 reference values and AreaFE % predicted.
+    # Each patient goes through check_acceptability_of_spirogram -> finalize_signal -> get_FE_signal
+    # -> areaFE / angle of collapse / deflating balloon, spread over a process pool
+    def __init__(self, FVLData, Clinical=None, flag_given_signal_is_FE=True, trialID="Best"):
+        self.FVLData=FVLData
+        self.Clinical=Clinical if Clinical is not None else {}
+        self.flag_given_signal_is_FE=flag_given_signal_is_FE
+        self.trialID=trialID
+
+    def get_patient_seed(self, patientID, seed):
+        # Seed derived from the run seed and the patient ID only, so that results do not
+        # depend on the number of workers or on the order in which patients are processed
+        import zlib
+        import numpy as np
+        seq=np.random.SeedSequence([seed, zlib.crc32(str(patientID).encode())])
+        return int(seq.generate_state(1)[0])
+
+    @staticmethod
+    def process_patient(job):
+        # Runs the processing chain for one patient. Errors are captured in the result
+        # instead of being raised so that a bad recording does not abort the run
+        import traceback
+        import numpy as np
+        from .spiro_signal_process import spiro_signal_process
+        from .spiro_features_extraction import spiro_features_extraction
+
+        patID, data, clinical, settings, seed, prior = job
+        result={'patientID':patID, 'accepted':False, 'reason':None, 'error':None, 'seed':seed}
+        try:
+            np.random.seed(seed)
+            sp=spiro_signal_process(data[0], data[1], data[2], patID, settings['trialID'],
+                                    settings['flag_given_signal_is_FE'])
+            flag_accept, reason = sp.check_acceptability_of_spirogram()
+            result['accepted']=flag_accept
+            result['reason']=reason
+            if not flag_accept:
+                return patID, result
+
+            sex, age, height = clinical if clinical is not None else (None, None, None)
+            if age is not None:
+                age=float(age)
+            if height is not None:
+                height=float(height)
+            sp.finalize_signal(sex, age, height)
+            for param in ['FEV1','FVC','Tiff','PEF','FEF25','FEF50','FEF75','FEF25_75']:
+                result[param]=getattr(sp, param)
+                result[param+'_PerPred']=getattr(sp, param+'_PerPred', None)
+
+            features=settings['features']
+            if len(features)>0:
+                FE_time, FE_vol, FE_flow = sp.get_FE_signal(start_type=settings['start_type'],
+                                                           thresh_percent_begin=settings['thresh_percent_begin'])
+            if 'areaFE' in features:
+                aFE=spiro_features_extraction.areaFE(FE_vol, FE_flow, sex, age, height)
+                result['AreaFE']=aFE.calc_areaFE()
+                if sex is not None:
+                    result['AreaFE_PerPred']=100*result['AreaFE']/aFE.calc_AreaPred()
+            if 'AC' in features:
+                ac=spiro_features_extraction.angle_of_collapse(FE_vol, FE_flow)
+                result['AC'], result['AC_Jmin'] = ac.calc_AC()
+            if 'balloon' in features:
+                db=spiro_features_extraction.deflating_baloon(FE_time, FE_vol, FE_flow)
+                balloon_kwargs=settings['balloon_kwargs']
+                if prior is not None:
+                    balloon_kwargs=dict(balloon_kwargs, prior=prior)
+                db.run_model("", **balloon_kwargs)
+                for param in ['wn','zeta','cost','mse_volume','mse_flow','R2_volume','R2_flow']:
+                    result[param]=getattr(db, param)
+            if settings['return_signals']:
+                result['sp']=sp
+        except Exception as e:
+            result['error']=repr(e)
+            result['traceback']=traceback.format_exc()
+        return patID, result
+
+    def run(self, n_workers=None, chunksize=16, seed=0, features=('areaFE','AC','balloon'),
+            start_type='thresh_PEF', thresh_percent_begin=1, balloon_kwargs=None, return_signals=False):
+        '''
+        Processes all patients and returns a dictionary {patientID: result}, where result is a
+        dictionary of spirometry parameters, features, acceptance and rejection reason, and the
+        error message if processing failed
+        Inputs:
+        1. n_workers: number of worker processes (None: number of CPUs, 1: no pool)
+        2. chunksize: number of patients sent to a worker at once
+        3. seed: run seed, each patient gets a seed derived from it and its patient ID
+        4. features: any of 'areaFE', 'AC' and 'balloon'
+        5. start_type, thresh_percent_begin: passed to get_FE_signal for the features
+        6. balloon_kwargs: keyword arguments for deflating_baloon.run_model. With a utilities.fit_history
+           as 'history', each patient's fit starts from its previous fit and the history is updated
+           with the new fits (call its save method to keep them). Only the patient's prior is sent
+           with each job, the history stays in this process
+        7. return_signals: keep the processed spiro_signal_process object in the result ('sp')
+        '''
+        balloon_kwargs=dict(balloon_kwargs) if balloon_kwargs is not None else {}
+        history=balloon_kwargs.pop('history', None)
+        # an explicit prior takes precedence over the history, as in run_model
+        use_history=history is not None and balloon_kwargs.get('prior') is None
+        settings={'trialID':self.trialID,
+                  'flag_given_signal_is_FE':self.flag_given_signal_is_FE,
+                  'features':tuple(features),
+                  'start_type':start_type,
+                  'thresh_percent_begin':thresh_percent_begin,
+                  'balloon_kwargs':balloon_kwargs,
+                  'return_signals':return_signals}
+        jobs=[(patID, self.FVLData[patID], self.Clinical.get(patID), settings,
+               self.get_patient_seed(patID, seed), history.get(patID) if use_history else None)
+              for patID in self.FVLData]
+
+        if n_workers==1:
+            results=map(spiro_cohort_process.process_patient, jobs)
+            self.results=dict(results)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                self.results=dict(executor.map(spiro_cohort_process.process_patient, jobs, chunksize=chunksize))
+        if history is not None:
+            for patID, result in self.results.items():
+                if result.get('wn') is not None:
+                    history.add(patID, result['wn'], result['zeta'])
+        return self.results
+
+    def results_to_dataframe(self):
+        # Results of the last run as a dataframe indexed by patient ID
+        import pandas as pd
+        rows=[{k:v for k,v in res.items() if k not in ['sp','traceback']} for res in self.results.values()]
+        return pd.DataFrame(rows).set_index('patientID')
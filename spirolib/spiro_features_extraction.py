@@ -4,9 +4,7 @@ Class for extracting features from spirometry signals using mathematical models.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import differential_evolution
-from .utilities import utilities
+from .utilities import utilities, balloon_lut, fit_budget
 
 class spiro_features_extraction:
     '''
@@ -115,6 +113,96 @@ class spiro_features_extraction:
             
             return line_model_vol, line_model_flow
             
+        def line_model_errors(self):
+            # Cost J of the line model for every candidate breakpoint i = 1..n-2
+            # Both segments are linear in volume, so the squared error of each side expands into
+            # prefix (left) and suffix (right) sums over the samples, which is O(n). Samples that
+            # np.interp clamps (only present when volume is not monotonic) are corrected afterwards
+            # with block_sums, which is O(n log^2 n)
+            # J is exact up to rounding, min_line_model_error rescores near-ties with generate_linemodel
+            volume=np.asarray(self.volume,dtype=float)
+            flow=np.asarray(self.flow,dtype=float)
+            n=len(volume)
+            if n<3:
+                return np.zeros(0)
+            
+            x0=volume[0]
+            y0=flow[0]
+            xn=volume[-1]
+            yn=flow[-1]
+            ind=np.arange(1,n-1)
+            x=volume[ind]
+            y=flow[ind]
+            
+            def prefix(arr):
+                return np.cumsum(arr)[ind]
+            
+            def suffix(arr):
+                return np.cumsum(arr[::-1])[::-1][ind+1]
+            
+            def block_sums(rank,W,L,r_lo,r_hi):
+                # Sums of the rows of W over samples k<L[j] with r_lo[j]<=rank[k]<r_hi[j], for every j
+                # [0,L) is split into dyadic blocks, samples are sorted by rank inside the blocks of
+                # each level, so every (block, rank range) is one searchsorted: O(n log^2 n)
+                out=np.zeros((len(L),W.shape[1]))
+                k=np.arange(n)
+                level=0
+                while (1<<level)<=n:
+                    key=(k>>level)*n+rank
+                    order=np.argsort(key,kind='stable')
+                    key=key[order]
+                    cum=np.vstack((np.zeros(W.shape[1]),np.cumsum(W[order],axis=0)))
+                    has=((L>>level)&1)==1
+                    b=(L[has]>>level)-1
+                    start=np.searchsorted(key,b*n+r_lo[has],side='left')
+                    end=np.searchsorted(key,b*n+r_hi[has],side='left')
+                    out[has]+=cum[end]-cum[start]
+                    level+=1
+                return out
+            
+            # Left segment: points 0..i on the line from (x0,y0) to (x,y)
+            u=volume-x0
+            g=y0-flow
+            a=x-x0
+            flat_left=(a==0) # np.interp returns y for all points when x==x0
+            c=np.where(flat_left,0.0,(y-y0)/np.where(flat_left,1.0,a))
+            e=np.where(flat_left,y-y0,0.0)
+            J=prefix(g*g)+2*c*prefix(g*u)+c*c*prefix(u*u)+e*(2*prefix(g)+(ind+1)*e)
+            below=u<0 # clamped to y0
+            if np.any(below):
+                J-=2*c*prefix(np.where(below,g*u,0))+c*c*prefix(np.where(below,u*u,0))+2*e*prefix(np.where(below,g,0))+e*e*prefix(below)
+            
+            # Right segment: points i+1..n-1 on the line from (x,y) to (xn,yn)
+            w=xn-volume
+            q=yn-flow
+            b=xn-x
+            d=np.where(b==0,0.0,(y-yn)/np.where(b==0,1.0,b))
+            J+=suffix(q*q)+2*d*suffix(q*w)+d*d*suffix(w*w)
+            above=w<0 # clamped to yn
+            if np.any(above):
+                J-=2*d*suffix(np.where(above,q*w,0))+d*d*suffix(np.where(above,w*w,0))
+            
+            # Samples on the wrong side of the breakpoint are clamped to y
+            regular=(x>=x0)&(x<=xn)
+            sorted_volume=np.sort(volume)
+            rank=np.searchsorted(sorted_volume,volume,side='left')
+            # left: k<=i with volume[k]>x
+            S=block_sums(rank,np.column_stack((np.ones(n),flow,flow*flow,g*g,u*u,g*u,g,u)),np.where(regular,ind+1,0),
+                         np.searchsorted(sorted_volume,x,side='right'),np.full(len(x),n))
+            J+=(y*y*S[:,0]-2*y*S[:,1]+S[:,2]
+                -(S[:,3]+c*c*S[:,4]+e*e*S[:,0]+2*c*S[:,5]+2*e*S[:,6]+2*c*e*S[:,7]))
+            # right: k>i with volume[k]<x, as a prefix of the reversed signal
+            S=block_sums(rank[::-1],np.column_stack((np.ones(n),flow,flow*flow,q*q,q*w,w*w))[::-1],np.where(regular,n-1-ind,0),
+                         np.zeros(len(x),dtype=int),np.searchsorted(sorted_volume,x,side='left'))
+            J+=y*y*S[:,0]-2*y*S[:,1]+S[:,2]-(S[:,3]+2*d*S[:,4]+d*d*S[:,5])
+            
+            # Breakpoints outside [x0,xn] are left to np.interp
+            for j in np.flatnonzero(~regular):
+                _, line_model_flow = self.generate_linemodel(x[j],y[j],ind[j])
+                J[j]=np.sum((line_model_flow-flow)**2)
+            
+            return J/n
+        
         def min_line_model_error(self, plotProcess = False):       
             # gen model by interpolating
             Jmin=1e10
@@ -122,32 +210,32 @@ class spiro_features_extraction:
             y_hat=None
             ind_min=None
             n=len(self.volume)
-            # loop over all points
-            ## NOTE: Efficient implementation is required
             if plotProcess:
+                import matplotlib.pyplot as plt
                 plt.figure(figsize=(5,4), dpi= 100, facecolor='w', edgecolor='k')
                 plt.title('Angle of collapse fitting process')
+                for i in range(20,n-1,20):
+                    line_model_vol, line_model_flow=self.generate_linemodel(self.volume[i], self.flow[i], i)
+                    plt.plot(line_model_vol,line_model_flow)
             
-            fvc = self.volume[-1] 
+            # score all points at once
+            J=self.line_model_errors()
+            if len(J)>0:
+                # candidates within rounding of the minimum are rescored exactly, in index order,
+                # so that ties are broken as by the point by point loop (last minimum wins)
+                tol=1e-9*np.max(np.abs(self.flow))**2
+                near=np.flatnonzero(J<=np.min(J)+2*tol)
+                if len(near)>64:
+                    near=np.sort(near[np.lexsort((-near,J[near]))[:64]])
+                for i in near+1:
+                    _, line_model_flow = self.generate_linemodel(self.volume[i],self.flow[i],i)
+                    J_i=(np.sum((line_model_flow-self.flow)**2))/n
+                    if J_i<=Jmin:
+                        Jmin=J_i
+                        ind_min=int(i)
+                        x_hat=self.volume[ind_min]
+                        y_hat=self.flow[ind_min]
             
-            for i in range(1,n-1):
-                
-                x=self.volume[i]
-                y=self.flow[i]
-                _, line_model_flow = self.generate_linemodel(x,y,i)
-                J=(np.sum((line_model_flow-self.flow)**2))/n
-                
-                if plotProcess:
-                    if (i%20==0):
-                        line_model_vol, line_model_flow=self.generate_linemodel(x, y, i)
-                        plt.plot(line_model_vol,line_model_flow)
-                    
-                
-                if J<=Jmin:
-                    Jmin=J
-                    x_hat=x
-                    y_hat=y
-                    ind_min=i
             if plotProcess:
                 plt.plot(self.volume,self.flow, color = 'black')
             return x_hat, y_hat, Jmin, ind_min
@@ -162,10 +250,19 @@ class spiro_features_extraction:
             line_model_angle= 180-(np.angle(z2,deg=True)- np.angle(z1,deg=True))
             return line_model_angle
         
-        def calc_AC(self, plotModel = False, plotProcess = False):
+        def calc_AC(self, plotModel = False, plotProcess = False, cache = None):
+            # cache: optional utilities.result_cache, reused when volume and flow are unchanged
             volume=self.volume
             flow=self.flow
-            x_hat, y_hat, Jmin, ind_min =self.min_line_model_error(plotProcess)
+            if cache is not None and not plotProcess:
+                key=cache.get_key('angle_of_collapse.calc_AC', [volume, flow], {})
+                cached=cache.get(key)
+                if cached is None:
+                    cached=self.min_line_model_error()
+                    cache.put(key, cached)
+                x_hat, y_hat, Jmin, ind_min = cached
+            else:
+                x_hat, y_hat, Jmin, ind_min =self.min_line_model_error(plotProcess)
             AC = self.get_angle(x_hat, y_hat)
             
             if plotModel:
@@ -191,6 +288,10 @@ class spiro_features_extraction:
             (in the FVL TLC should be at 0 and RV>0, flow>0,FVL is right skewed)
              and units standerdized (vol in litres, flow in litres/s and time in s)
         '''     
+        # Fit outputs stored by run_model in a result_cache, the model signals are rebuilt from them
+        cached_attributes=['wn','zeta','alpha','a0','k_flow_slope','PEF','cost','nfev','converged','warm_started',
+                           'mse_volume','mse_flow','R2_volume','R2_flow']
+
         def __init__(self,FE_time, FE_volume, FE_flow):
             self.FE_time=FE_time
             self.FE_volume=FE_volume
@@ -356,7 +457,100 @@ class spiro_features_extraction:
                 ind = self.excitation_index
                 J=np.sum((h[ind:] - FE_vol_o[ind:] )**2)+np.sum((h_dash[ind:]  - FE_flow_o[ind:])**2)
             return J
-        
+
+        def prepare_vectorized_cost(self,popsize=15):
+            # Slice the signal after the excitation index once and preallocate a
+            # (popsize x n) workspace for Cost_Function_vectorized (default excitation only)
+            ind=self.excitation_index
+            self.tau=self.FE_time[ind:]-self.FE_time[ind]
+            self.FE_vol_os=self.FE_vol_o[ind:]
+            self.FE_flow_os=self.FE_flow_o[ind:]
+            self.workspace=np.empty((4,2*popsize,len(self.tau)))
+
+        def Cost_Function_vectorized(self,params):
+            # Cost of a whole population, params has shape (2, S) as passed by
+            # differential_evolution(vectorized=True). Same cost as Cost_Function
+            params=np.asarray(params)
+            if params.ndim==2 and params.shape[1]>self.workspace.shape[1]:
+                self.workspace=np.empty((4,params.shape[1],len(self.tau)))
+            ut=utilities()
+            # single candidates come from differential_evolution workers, which may run
+            # concurrently in threads, so they do not share the workspace
+            J=ut.calc_balloon_cost(params,self.tau,self.FE_vol_os,self.FE_flow_os,
+                                   self.FE_vol_os[0],self.FE_flow_os[0],self.workspace if params.ndim==2 else None)
+            if params.ndim==1:
+                return J[0]
+            return J
+
+        def get_decimation_factor(self,target_dt=0.05):
+            # Number of samples averaged into one for the coarse fit, so that the decimated
+            # signal after PEF is sampled about every target_dt seconds
+            dt=np.median(np.diff(self.tau)) if len(self.tau)>1 else target_dt
+            if not dt>0:
+                return 1
+            return max(1,int(target_dt/dt))
+
+        def decimate_signal(self,q):
+            # Anti-aliased (block mean) copy of the signal after PEF, call prepare_vectorized_cost first
+            # The first sample is kept as is since it holds the initial conditions of the model
+            n=(len(self.tau)-1)//q
+            def block_mean(x):
+                return np.append(x[0],x[1:1+n*q].reshape(n,q).mean(axis=1))
+            return block_mean(self.tau), block_mean(self.FE_vol_os), block_mean(self.FE_flow_os)
+
+        def fit_coarse_to_fine(self,solver="de",bounds=[(0,3),(1,6)],target_dt=0.05,narrow=0.1,de_options=None,budget=None):
+            # Fits the default model on a decimated copy of the signal with the given solver, then
+            # refines on the full signal by least squares started from the coarse solution, within
+            # a box of +/- narrow times the bounds around it
+            # de_options: keyword arguments passed to differential_evolution (seed, workers, popsize, ...)
+            # budget: optional utilities.fit_budget accounting for the differential_evolution calls
+            # Returns wn, zeta, the cost J on the full signal and the number of function evaluations
+            import functools
+            from scipy.optimize import differential_evolution
+            ut=utilities()
+            if budget is None:
+                budget=fit_budget()
+            if de_options is None:
+                de_options={}
+            self.prepare_vectorized_cost(de_options.get('popsize',15))
+            # the workers keyword overrides vectorized in differential_evolution
+            de_options=dict(de_options,vectorized=de_options.get('workers',1)==1,updating='deferred')
+            population=fit_budget.get_population(de_options.get('popsize',15),len(bounds)) if de_options['vectorized'] else 1
+            if budget.is_active():
+                de_options['callback']=budget.get_callback(population)
+            x_t1=self.FE_vol_os[0]
+            xdot_t1=self.FE_flow_os[0]
+            q=self.get_decimation_factor(target_dt)
+            self.decimation_factor=q
+            if q==1: # already coarse
+                fine_bounds=bounds
+                x0=None
+                nfev=0
+            else:
+                tau_c,vol_c,flow_c=self.decimate_signal(q)
+                if solver=="lsq":
+                    x0=ut.fit_balloon_lsq(tau_c,vol_c,flow_c,x_t1,xdot_t1,bounds=bounds)
+                    nfev=x0[3]
+                    x0=np.array(x0[:2])
+                else:
+                    work=np.empty((4,2*de_options.get('popsize',15),len(tau_c))) if de_options['vectorized'] else None
+                    cost=functools.partial(ut.calc_balloon_cost,tau=tau_c,vol=vol_c,flow=flow_c,x_t1=x_t1,
+                                           xdot_t1=xdot_t1,work=work)
+                    res=differential_evolution(cost,bounds=bounds,strategy='best1bin',**de_options)
+                    nfev=budget.add_result(res,population)
+                    x0=res.x
+                self.coarse_params=x0
+                width=narrow*np.array([b[1]-b[0] for b in bounds])
+                fine_bounds=[(max(lo,x-w),min(hi,x+w)) for (lo,hi),x,w in zip(bounds,x0,width)]
+            if x0 is None and solver=="de":
+                res=differential_evolution(self.Cost_Function_vectorized,bounds=bounds,strategy='best1bin',**de_options)
+                return res.x[0],res.x[1],res.fun,budget.add_result(res,population)
+            # local refinement with the analytic Jacobian
+            starts=None if x0 is None else [x0]
+            wn,zeta,J,n=ut.fit_balloon_lsq(self.tau,self.FE_vol_os,self.FE_flow_os,x_t1,xdot_t1,
+                                          bounds=fine_bounds,starts=starts)
+            return wn,zeta,J,nfev+n
+
         def Cost_func_exp_pressure(self, params): # Discarded
             alpha=params[0]
             a0 = params[1]
@@ -372,7 +566,145 @@ class spiro_features_extraction:
             J=np.sum((h1 - FE_vol_o[0:excitation_index+1])**2)+np.sum((h1_dash - FE_flow_o[0:excitation_index+1])**2)
             return J
         
+        def fit_from_prior(self,prior,bounds=[(0,3),(1,6)],narrow=0.1,max_rel_cost=0.05):
+            # Local least-squares fit of the default model started from a prior (wn, zeta), within a box
+            # of +/- narrow times the bounds around it. The fit is rejected when it ends on an edge of
+            # that box which lies inside the bounds, i.e. the optimum is probably outside the box, or
+            # when its cost exceeds max_rel_cost times the spread of the signal (sum of squares of volume
+            # and flow about their means, i.e. a combined R2 below 1-max_rel_cost)
+            # Returns wn, zeta, the cost J, the number of function evaluations and the acceptance flag
+            ut=utilities()
+            self.prepare_vectorized_cost()
+            lb=np.array([b[0] for b in bounds])
+            ub=np.array([b[1] for b in bounds])
+            x0=np.clip(np.asarray(prior,dtype=float),lb,ub)
+            width=narrow*(ub-lb)
+            box_lb=np.maximum(lb,x0-width)
+            box_ub=np.minimum(ub,x0+width)
+            wn,zeta,J,nfev=ut.fit_balloon_lsq(self.tau,self.FE_vol_os,self.FE_flow_os,self.FE_vol_os[0],self.FE_flow_os[0],
+                                             bounds=list(zip(box_lb,box_ub)),starts=[x0])
+            x=np.array([wn,zeta])
+            tol=1e-3*width
+            on_edge=((x-box_lb<tol)&(box_lb>lb))|((box_ub-x<tol)&(box_ub<ub))
+            spread=np.sum((self.FE_vol_os-np.mean(self.FE_vol_os))**2)+np.sum((self.FE_flow_os-np.mean(self.FE_flow_os))**2)
+            good_fit=J<=max_rel_cost*spread
+            return wn,zeta,J,nfev,bool(np.isfinite(J) and good_fit and not np.any(on_edge))
+
+        def run_sweep(self,wn=None,zeta=None,return_curves=False,decimals=2):
+            '''
+            Evaluates the default model (initial conditions at PEF) for many parameter values in
+            one broadcast, without plotting. Requires run_model to be run first
+            Inputs:
+            1. wn, zeta: arrays of parameter values, broadcast against each other (e.g. from np.meshgrid).
+               Default to the fitted values
+            2. return_curves: also return the model volume and flow curves
+            3. decimals: rounding of FEV1 and FVC as in calc_FEV1_FVC, None for unrounded values
+            Returns a dictionary with arrays 'wn', 'zeta', 'FEV1', 'FVC' of the broadcast shape and,
+            with return_curves, 'model_volume' and 'model_flow' with an extra last axis over FE_time
+            '''
+            if self.excitation_type in ["Linear","Exponential pressure", "Non linear"]:
+                raise Exception('run_sweep supports the default excitation only')
+            wn,zeta=np.broadcast_arrays(np.asarray(self.wn if wn is None else wn,dtype=float),
+                                        np.asarray(self.zeta if zeta is None else zeta,dtype=float))
+            shape=wn.shape
+            w=wn.reshape(-1,1)
+            z=zeta.reshape(-1,1)
+
+            FE_time=self.FE_time
+            ind=self.excitation_index
+            n=len(FE_time)
+            x_t1=self.FE_vol_o[ind]
+            xdot_t1=self.FE_flow_o[ind]
+            del_v=self.FVC-x_t1
+
+            # samples needed for FEV1 (the first sample at or after 1 s, see calc_FEV1_FVC) and FVC
+            index_1s=np.searchsorted(FE_time,FE_time[0]+1,side='left')
+            if return_curves:
+                cols=np.arange(ind,n)
+            else:
+                cols=np.unique([ind,max(index_1s,ind),n-1])
+            tau=FE_time[cols]-FE_time[ind]
+
+            # same closed form as calc_hypothesis
+            with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+                s1=(-z+np.sqrt(z**2-1))*w
+                s2=(-z-np.sqrt(z**2-1))*w
+                s3=(z+np.sqrt(z**2-1))*w
+                s4=(z-np.sqrt(z**2-1))*w
+                s5=2*w*np.sqrt(z**2-1)
+                C1=(x_t1*s3+xdot_t1)/s5
+                C2=(-x_t1*s4-xdot_t1)/s5
+                e1=np.exp(s1*tau)
+                e2=np.exp(s2*tau)
+                h2=C1*e1+C2*e2
+                h2_dash=s1*C1*e1+s2*C2*e2
+
+            # reorient as in reorient_model, h2[:,0] is the model volume at PEF
+            h_ind=h2[:,:1]
+            def volume_at(col):
+                if col<ind:
+                    return np.abs(self.FE_vol_o[col]-h_ind[:,0])+del_v
+                return np.abs(h2[:,np.searchsorted(cols,col)]-h_ind[:,0])+del_v
+            FEV1=np.abs(volume_at(index_1s))
+            FVC=np.abs(volume_at(n-1))
+            if decimals is not None:
+                FEV1=np.round(FEV1,decimals)
+                FVC=np.round(FVC,decimals)
+            sweep={'wn':wn,'zeta':zeta,'FEV1':FEV1.reshape(shape),'FVC':FVC.reshape(shape)}
+
+            if return_curves:
+                S=len(w)
+                model_volume=np.empty((S,n))
+                model_flow=np.empty((S,n))
+                model_volume[:,:ind]=np.abs(self.FE_vol_o[:ind]-h_ind)+del_v
+                model_volume[:,ind:]=np.abs(h2-h_ind)+del_v
+                model_flow[:,:ind]=-self.FE_flow_o[:ind]
+                model_flow[:,ind:]=-h2_dash
+                sweep['model_volume']=model_volume.reshape(shape+(n,))
+                sweep['model_flow']=model_flow.reshape(shape+(n,))
+            return sweep
+
+        def plot_sweep(self,sweep,only_FVL=True,max_curves=50):
+            # Plots the model curves of a run_sweep result (at most max_curves of them, evenly spaced)
+            # together with the measured signal
+            import matplotlib.pyplot as plt
+            if 'model_volume' not in sweep:
+                raise Exception('Sweep has no curves, run run_sweep with return_curves=True')
+            n=self.FE_time.shape[0]
+            model_volume=sweep['model_volume'].reshape(-1,n)
+            model_flow=sweep['model_flow'].reshape(-1,n)
+            wn=sweep['wn'].ravel()
+            zeta=sweep['zeta'].ravel()
+            FEV1=sweep['FEV1'].ravel()
+            FVC=sweep['FVC'].ravel()
+            ind=self.excitation_index
+            show=np.unique(np.linspace(0,len(wn)-1,min(len(wn),max_curves)).astype(int))
+
+            if only_FVL:
+                plt.figure(figsize=(7,6), dpi= 100, facecolor='w', edgecolor='k')
+                axes=[plt.gca()]
+            else:
+                plt.figure(figsize=(6.5,12), dpi= 100, facecolor='w', edgecolor='k')
+                axes=[plt.subplot(3,1,k) for k in (1,2,3)]
+            axes[0].plot(self.FE_volume,self.FE_flow,color='black',linewidth=1.5,label='Original')
+            if not only_FVL:
+                axes[1].plot(self.FE_time,self.FE_volume,color='black',linewidth=1.5,label='Original')
+                axes[2].plot(self.FE_time,self.FE_flow,color='black',linewidth=1.5,label='Original')
+            for k in show:
+                label="ω = "+str(round(wn[k],2))+", ζ = "+str(round(zeta[k],2))+", FEV1 = "+str(FEV1[k])+" L, FVC = "+str(FVC[k])+" L"
+                axes[0].plot(model_volume[k,ind:],model_flow[k,ind:],'--',linewidth=1,label=label)
+                if not only_FVL:
+                    axes[1].plot(self.FE_time[ind:],model_volume[k,ind:],'--',linewidth=1,label=label)
+                    axes[2].plot(self.FE_time[ind:],model_flow[k,ind:],'--',linewidth=1,label=label)
+            for ax,(xlabel,ylabel) in zip(axes,[('Volume (L)','Flow (L/s)'),('Time (s)','Volume (L)'),('Time (s)','Flow (L/s)')]):
+                ax.set_xlabel(xlabel)
+                ax.set_ylabel(ylabel)
+                ax.grid(True,which='both')
+            if len(show)<=10:
+                axes[0].legend()
+
         def run_simulation(self,sim_param = 'zeta',sim_type="",num_sims=4, percentage_step=10, plot_FVL_only = True):
+            import matplotlib.pyplot as plt
             # Read optimal parameters
             wn = self.wn
             zeta = self.zeta
@@ -393,30 +725,47 @@ class spiro_features_extraction:
             
             markerstyles= [".","*","-","x","2"]
             
-            for step in np.arange(-np.floor(num_sims/2), np.floor(num_sims/2)+1):
-                # Update simulation parameter
-                if sim_param=="alpha":  
-                    alpha = self.alpha + step * (percentage_step/100) * self.alpha
-                elif sim_param=="zeta":
-                    zeta = self.zeta + step * (percentage_step/100) * self.zeta
-                elif sim_param=="omega":
-                    wn = self.wn + step * (percentage_step/100) * self.wn
-                    
-                # Prepare parameter list
-                if sim_type == "Exponential pressure":
-                    param_list = [wn,zeta,alpha, a0]
-                elif sim_type =="Non linear":
-                    param_list = [wn,zeta,alpha]
-                
+            steps=np.arange(-np.floor(num_sims/2), np.floor(num_sims/2)+1)
+            sweep=None
+            if (self.excitation_type not in ["Linear","Exponential pressure", "Non linear"] and
+                    sim_type not in ["Exponential pressure","Non linear"] and sim_param in ["zeta","omega"]):
+                # default model, all steps in one broadcast
+                if sim_param=="zeta":
+                    sweep=self.run_sweep(zeta=self.zeta + steps * (percentage_step/100) * self.zeta, return_curves=True)
                 else:
-                    param_list = [wn,zeta]
+                    sweep=self.run_sweep(wn=self.wn + steps * (percentage_step/100) * self.wn, return_curves=True)
+            
+            for k,step in enumerate(steps):
+                if sweep is not None:
+                    wn=sweep['wn'][k]
+                    zeta=sweep['zeta'][k]
+                    model_volume=sweep['model_volume'][k]
+                    model_flow=sweep['model_flow'][k]
+                    FEV1, FVC = sweep['FEV1'][k], sweep['FVC'][k]
+                else:
+                    # Update simulation parameter
+                    if sim_param=="alpha":  
+                        alpha = self.alpha + step * (percentage_step/100) * self.alpha
+                    elif sim_param=="zeta":
+                        zeta = self.zeta + step * (percentage_step/100) * self.zeta
+                    elif sim_param=="omega":
+                        wn = self.wn + step * (percentage_step/100) * self.wn
+                        
+                    # Prepare parameter list
+                    if sim_type == "Exponential pressure":
+                        param_list = [wn,zeta,alpha, a0]
+                    elif sim_type =="Non linear":
+                        param_list = [wn,zeta,alpha]
                     
-                # calculate model flow and volume
-                self.model_volume,self.model_flow = self.calc_hypothesis(param_list)
-                self.reorient_model()
-#                model_volume = self.model_volume
-#                model_flow = self.model_flow
-                FEV1, FVC = self.calc_FEV1_FVC()
+                    else:
+                        param_list = [wn,zeta]
+                        
+                    # calculate model flow and volume
+                    self.model_volume,self.model_flow = self.calc_hypothesis(param_list)
+                    self.reorient_model()
+                    model_volume = self.model_volume
+                    model_flow = self.model_flow
+                    FEV1, FVC = self.calc_FEV1_FVC()
                 
                 # plots
                 if sim_param=='zeta':
@@ -437,9 +786,9 @@ class spiro_features_extraction:
                 #label =sim_param_code+" " + str(step * (percentage_step)) + " %" +", FEV1  = "+str(FEV1)+" L, FVC = " + str(FVC)+" L"
                 if plot_FVL_only:
                     if self.excitation_type in ["Linear","Exponential pressure", "Non linear"]:
-                        plt.plot(self.model_volume,self.model_flow,markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(model_volume,model_flow,markerstyles[int(step+2)],linewidth=2,label=label)
                     else:
-                        plt.plot(self.model_volume[ind:],self.model_flow[ind:],markerstyles[int(step+2)],linewidth=1.5,label=label)
+                        plt.plot(model_volume[ind:],model_flow[ind:],markerstyles[int(step+2)],linewidth=1.5,label=label)
                     plt.xlabel('Volume (L)',fontsize=11,weight='normal')
                     plt.ylabel('Flow (L/s)',fontsize=11,weight='normal')
                     plt.grid(True,which='both')
@@ -447,9 +796,9 @@ class spiro_features_extraction:
                 else:
                     plt.subplot(3,1,1)
                     if self.excitation_type in ["Linear","Exponential pressure", "Non linear"]:
-                        plt.plot(self.model_volume,self.model_flow,markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(model_volume,model_flow,markerstyles[int(step+2)],linewidth=2,label=label)
                     else:
-                        plt.plot(self.model_volume[ind:],self.model_flow[ind:],markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(model_volume[ind:],model_flow[ind:],markerstyles[int(step+2)],linewidth=2,label=label)
                     plt.xlabel('Volume (L)',fontsize=12,weight='normal')
                     plt.ylabel('Flow (L/s)',fontsize=12,weight='normal')
                     plt.grid(True,which='both')
@@ -457,9 +806,9 @@ class spiro_features_extraction:
                     
                     plt.subplot(3,1,2)
                     if self.excitation_type in ["Linear","Exponential pressure", "Non linear"]:
-                        plt.plot(self.FE_time, self.model_volume,markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(self.FE_time, model_volume,markerstyles[int(step+2)],linewidth=2,label=label)
                     else:
-                        plt.plot(self.FE_time[ind:], self.model_volume[ind:],markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(self.FE_time[ind:], model_volume[ind:],markerstyles[int(step+2)],linewidth=2,label=label)
                     plt.xlabel('Time (s)',fontsize=12,weight='normal')
                     plt.ylabel('Volume (L)',fontsize=12,weight='normal')
                     plt.grid(True,which='both')
@@ -467,9 +816,9 @@ class spiro_features_extraction:
                     
                     plt.subplot(3,1,3)
                     if self.excitation_type in ["Linear","Exponential pressure", "Non linear"]:
-                        plt.plot(self.FE_time, self.model_flow,markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(self.FE_time, model_flow,markerstyles[int(step+2)],linewidth=2,label=label)
                     else:
-                        plt.plot(self.FE_time[ind:], self.model_flow[ind:],markerstyles[int(step+2)],linewidth=2,label=label)
+                        plt.plot(self.FE_time[ind:], model_flow[ind:],markerstyles[int(step+2)],linewidth=2,label=label)
                     plt.xlabel('Time (s)',fontsize=12,weight='normal')
                     plt.ylabel('Flow (L/s)',fontsize=12,weight='normal')
                     plt.grid(True,which='both')
@@ -478,7 +827,65 @@ class spiro_features_extraction:
             if plot_FVL_only:        
                 plt.plot(self.FE_volume[0:ind],self.FE_flow[0:ind],linewidth=1)
         
-        def run_model(self, excitation_type,plot_model=False, add_title_text="",plot_FVL_only=False):
+        def run_model(self, excitation_type,plot_model=False, add_title_text="",plot_FVL_only=False, vectorized=True, solver="de",
+                      cache=None, lut=None, coarse_to_fine=False, seed=None, workers=1, popsize=15, tol=0.01, maxiter=1000,
+                      budget_ms=None, max_nfev=None, prior=None, history=None, patientID=None):
+            # solver: "de" (differential evolution, global), "lsq" (multi-start trust-region least squares),
+            # "analytic" (closed-form linear estimate, no search, its cost stays above the "de" fit) or
+            # "analytic_lsq" (the closed-form estimate polished by least squares), "lut" (nearest fit in a utilities.balloon_lut table,
+            # passed as lut or shared by default fits, see balloon_lut.get_default) or "lut_lsq" (the nearest fit polished by
+            # least squares). Solvers other than "de" apply to the default excitation only.
+            # The cost reached is stored in self.cost
+            # coarse_to_fine: with the "de" or "lsq" solver, fit a decimated copy of the signal first and
+            # refine on the full signal in a narrowed box (see fit_coarse_to_fine)
+            # seed, workers, popsize, tol, maxiter: passed to every differential_evolution call. A seeded
+            # fit is reproducible, workers (an int or a map-like callable) spreads each population over a
+            # pool, in which case the population is scored one candidate per call
+            # budget_ms, max_nfev: with the "de" solver, stop with the best solution found so far once the
+            # time or evaluation budget of the whole fit is used up (see utilities.fit_budget, the final
+            # polish of differential_evolution is skipped). self.converged is False if a call did not converge.
+            # Evaluations are counted per candidate, as in self.nfev, with or without workers
+            # prior: (wn, zeta) of an earlier fit, e.g. of the same patient. With the "de" or "lsq" solver the
+            # model is first fitted locally around it (see fit_from_prior) and the full search only runs if
+            # that fit is poor, seeded with the prior. self.warm_started tells whether the local fit was kept
+            # history, patientID: utilities.fit_history to take the prior from (when prior is None) and to
+            # record the new fit in, under patientID (required with history)
+            # cache: optional utilities.result_cache. The fitted parameters, cost and fit metrics are stored
+            # and restored when the signal and settings are unchanged, the model signals are recalculated
+            if solver not in ["de","lsq","analytic","analytic_lsq","lut","lut_lsq"]:
+                raise Exception('Unknown solver: '+str(solver))
+            if coarse_to_fine and solver not in ["de","lsq"]:
+                raise Exception('coarse_to_fine requires the de or lsq solver')
+            budget=fit_budget(budget_ms,max_nfev)
+            if budget.is_active() and solver!="de":
+                raise Exception('budget_ms and max_nfev require the de solver')
+            if history is not None and patientID is None:
+                raise Exception('history requires the patientID of the signal')
+            if prior is None and history is not None:
+                prior=history.get(patientID)
+            if prior is not None and solver not in ["de","lsq"]:
+                raise Exception('prior requires the de or lsq solver')
+            if solver in ["lut","lut_lsq"] and lut is None:
+                lut=balloon_lut.get_default((0,3),(1,6),self.FE_time[-1]-self.FE_time[np.argmax(self.FE_flow)])
+            cached=None
+            if cache is not None:
+                settings={'excitation_type':excitation_type, 'vectorized':vectorized, 'solver':solver,
+                          'coarse_to_fine':coarse_to_fine, 'seed':seed, 'popsize':popsize, 'tol':tol, 'maxiter':maxiter,
+                          'budget':budget.is_active(), 'prior':None if prior is None else tuple(float(x) for x in prior)}
+                if solver in ["lut","lut_lsq"]:
+                    settings['lut']=lut.settings
+                key=cache.get_key('deflating_baloon.run_model', [self.FE_time, self.FE_volume, self.FE_flow], settings)
+                cached=cache.get(key)
+            if cached is None and (solver=="de" or excitation_type in ["Linear","Exponential pressure","Non linear"]):
+                from scipy.optimize import differential_evolution
+            # one generator is shared by successive calls so that a seeded fit is reproducible
+            de_options={'seed':None if seed is None else np.random.default_rng(seed),'workers':workers,
+                        'popsize':popsize,'tol':tol,'maxiter':maxiter}
+            if workers!=1:
+                de_options['updating']='deferred'
+            if budget.is_active():
+                de_options['callback']=budget.callback
+                de_options['polish']=False
             # Read signal
             FE_vol=self.FE_volume
             FE_flow=self.FE_flow
@@ -498,12 +905,26 @@ class spiro_features_extraction:
             ## Optimize cost function
             self.excitation_type=excitation_type
             
-            if excitation_type=="Linear": # Discarded module
+            if cached is not None:
+                # fit restored from the cache
+                self.__dict__.update(cached)
+                if excitation_type=="Linear":
+                    params=[self.wn,self.zeta]
+                elif excitation_type=="Exponential pressure":
+                    params=[self.wn,self.zeta,self.alpha,self.a0]
+                elif excitation_type=="Non linear":
+                    params=[self.wn,self.zeta,self.alpha]
+                else:
+                    params=[self.wn,self.zeta]
+                h,h_dash=self.calc_hypothesis(params)
+            
+            elif excitation_type=="Linear": # Discarded module
                 # flow slope
                 t1=self.FE_time[excitation_index]
                 k_flow_slope=FE_flow[excitation_index]/t1
                 self.k_flow_slope=k_flow_slope
-                param_final=differential_evolution(self.Cost_Function,bounds=[(0,10),(1,10)])
+                param_final=differential_evolution(self.Cost_Function,bounds=[(0,10),(1,10)],**de_options)
+                budget.add_result(param_final)
                 
                 # Collect final parameters
                 wn=param_final.x[0]
@@ -517,12 +938,16 @@ class spiro_features_extraction:
                 itn=1
                 Jmin=1E10
                 while itn<=3: # Run optimization three times and chose opt params with min J , done improve robustness of parameters
-                    PEF_params= differential_evolution(self.Cost_func_exp_pressure,bounds=[(1,50),(1,50)],strategy='best1bin')
+                    if itn>1 and budget.is_exhausted():
+                        break
+                    PEF_params= differential_evolution(self.Cost_func_exp_pressure,bounds=[(1,50),(1,50)],strategy='best1bin',**de_options)
+                    budget.add_result(PEF_params)
                     alpha_init = PEF_params.x[0]
                     a0_init = PEF_params.x[1]
                     
                     rad = 0.50
-                    param_final=differential_evolution(self.Cost_Function,bounds=[(0,10),(1,10),(alpha_init-rad*alpha_init,alpha_init+rad*alpha_init),(a0_init-rad*a0_init, a0_init+rad*a0_init)],strategy='best1bin')
+                    param_final=differential_evolution(self.Cost_Function,bounds=[(0,10),(1,10),(alpha_init-rad*alpha_init,alpha_init+rad*alpha_init),(a0_init-rad*a0_init, a0_init+rad*a0_init)],strategy='best1bin',**de_options)
+                    budget.add_result(param_final)
                     #param_final=differential_evolution(self.Cost_Function,bounds=[(0,10),(1,10),(0.01,100),(0.01,500)],strategy='best1bin')
                     # Collect final parameters
                     wn=param_final.x[0]
@@ -546,7 +971,8 @@ class spiro_features_extraction:
             elif excitation_type=="Non linear": # Non linear start
                 PEF=np.max(FE_flow)
                 self.PEF=PEF
-                param_final=differential_evolution(self.Cost_Function,bounds=[(0,2.5),(1,5),(0,-PEF)],strategy='best1bin')
+                param_final=differential_evolution(self.Cost_Function,bounds=[(0,2.5),(1,5),(0,-PEF)],strategy='best1bin',**de_options)
+                budget.add_result(param_final)
                 # Collect final parameters
                 wn=param_final.x[0]
                 zeta=param_final.x[1]
@@ -562,16 +988,65 @@ class spiro_features_extraction:
             else:  # default, with initial conditions vol(t1)= FVC-del_v and flow(t1) = PEF
                 PEF=np.max(FE_flow)
                 self.PEF=PEF
-                param_final=differential_evolution(self.Cost_Function,bounds=[(0,3),(1,6)],strategy='best1bin')
-                # Collect final parameters
-                wn=param_final.x[0]
-                zeta=param_final.x[1]
+                self.warm_started=False
+                nfev_prior=0
+                if prior is not None:
+                    # local fit around the prior, the full search below seeds its population with the prior
+                    wn,zeta,J,nfev_prior,self.warm_started=self.fit_from_prior(prior)
+                    de_options['x0']=np.clip(np.asarray(prior,dtype=float),[0,1],[3,6])
+                if self.warm_started:
+                    nfev=0
+                elif coarse_to_fine:
+                    # decimated fit first, then refined on the full signal
+                    wn,zeta,J,nfev=self.fit_coarse_to_fine(solver,de_options=de_options,budget=budget)
+                elif solver=="lsq":
+                    # trust-region least squares with the analytic Jacobian, multi-start
+                    self.prepare_vectorized_cost()
+                    ut=utilities()
+                    wn,zeta,J,nfev=ut.fit_balloon_lsq(self.tau,self.FE_vol_os,self.FE_flow_os,
+                                                     self.FE_vol_os[0],self.FE_flow_os[0],bounds=[(0,3),(1,6)])
+                elif solver in ["analytic","analytic_lsq"]:
+                    # one linear solve on the integral form of the model, optionally polished
+                    self.prepare_vectorized_cost()
+                    ut=utilities()
+                    wn,zeta,J,nfev=ut.fit_balloon_analytic(self.tau,self.FE_vol_os,self.FE_flow_os,
+                                                          self.FE_vol_os[0],self.FE_flow_os[0],bounds=[(0,3),(1,6)],
+                                                          refine=solver=="analytic_lsq")
+                elif solver in ["lut","lut_lsq"]:
+                    # score every grid point of the table at once, optionally polished
+                    self.prepare_vectorized_cost()
+                    wn,zeta,J,nfev=lut.fit(self.tau,self.FE_vol_os,self.FE_flow_os,
+                                           self.FE_vol_os[0],self.FE_flow_os[0],refine=solver=="lut_lsq")
+                else:
+                    population=1
+                    if vectorized:
+                        # score the whole population per generation (one candidate per call with workers)
+                        self.prepare_vectorized_cost(popsize)
+                        options=dict(de_options,vectorized=workers==1,updating='deferred')
+                        if workers==1:
+                            population=fit_budget.get_population(popsize,2)
+                            if budget.is_active():
+                                options['callback']=budget.get_callback(population)
+                        param_final=differential_evolution(self.Cost_Function_vectorized,bounds=[(0,3),(1,6)],strategy='best1bin',
+                                                           **options)
+                    else:
+                        param_final=differential_evolution(self.Cost_Function,bounds=[(0,3),(1,6)],strategy='best1bin',**de_options)
+                    # Collect final parameters
+                    wn=param_final.x[0]
+                    zeta=param_final.x[1]
+                    J=param_final.fun
+                    nfev=budget.add_result(param_final,population) # cost evaluations
                 self.wn=wn
                 self.zeta=zeta
+                self.cost=J # cost reached by the solver
+                self.nfev=nfev+nfev_prior
 
-                
                 # calculate model flow and volume
                 h,h_dash=self.calc_hypothesis([wn,zeta])
+            if cached is None:
+                self.converged=budget.converged # False if a differential_evolution call stopped early
+            if history is not None and excitation_type not in ["Linear","Exponential pressure","Non linear"] and not budget.stopped:
+                history.add(patientID,self.wn,self.zeta)
             
             self.model_volume=h
             self.model_flow=h_dash
@@ -581,7 +1056,8 @@ class spiro_features_extraction:
             self.reorient_model()
             
             # Calculate mean squared error
-            from sklearn.metrics import mean_squared_error,r2_score
+            ut=utilities()
+            mean_squared_error,r2_score=ut.calc_mse,ut.calc_r2_score
             if excitation_type in ["Linear", "Exponentifrom sklearn.metrics import mean_squared_error,r2_scoreal pressure", "Non linear"]:
                 self.mse_volume=mean_squared_error(self.FE_volume,self.model_volume)
                 self.mse_flow=mean_squared_error(self.FE_flow,self.model_flow)
@@ -594,11 +1070,15 @@ class spiro_features_extraction:
                 self.R2_volume=r2_score(self.FE_volume[ind:],self.model_volume[ind:])
                 self.R2_flow=r2_score(self.FE_flow[ind:],self.model_flow[ind:])
             
+            if cache is not None and cached is None and not budget.stopped: # fits cut short by the budget are not reproducible
+                cache.put(key, {k:getattr(self,k) for k in self.cached_attributes if hasattr(self,k)})
+            
             if plot_model:
                 self.plot_model(plot_FVL_only,add_title_text)
             
              
         def plot_model(self,only_FVL,add_title_text):
+            import matplotlib.pyplot as plt
             # Unpack signal
             FE_time=self.FE_time
             FE_vol=self.FE_volume
@@ -679,3 +1159,246 @@ class spiro_features_extraction:
                 plt.xlabel('Time (s)')
                 plt.ylabel('Flow (L/s)')
                 plt.legend()
+
+    class deflating_baloon_batch:
+        '''
+        Class for fitting the default deflating balloon model (initial conditions at PEF)
+        to many FE signals at once. Every optimizer generation scores the candidates of
+        all curves in one broadcast instead of running one differential_evolution per curve
+        Requires:
+        1. FE_signals: list of (FE_time, FE_volume, FE_flow) triples, as returned by
+           spiro_signal_process.get_FE_signal
+        Note: This class expects correctly positioned and shifted FE signals
+            (in the FVL TLC should be at 0 and RV>0, flow>0,FVL is right skewed)
+             and units standerdized (vol in litres, flow in litres/s and time in s)
+        '''
+        def __init__(self,FE_signals):
+            self.FE_signals=list(FE_signals)
+
+        def prepare_signals(self):
+            # Orient every signal as in deflating_baloon.orient_and_snip_signal and keep the part after PEF
+            self.tau=[]
+            self.FE_vol_os=[]
+            self.FE_flow_os=[]
+            self.del_v=[]
+            self.FE_volume_s=[]
+            self.FE_flow_s=[]
+            for FE_time,FE_vol,FE_flow in self.FE_signals:
+                FE_time=np.asarray(FE_time,dtype=float)
+                FE_vol=np.asarray(FE_vol,dtype=float)
+                FE_flow=np.asarray(FE_flow,dtype=float)
+                ind=np.argmax(FE_flow) # excitation index
+                FE_vol_o=np.abs(FE_vol-FE_vol[-1])
+                FE_flow_o=-FE_flow
+                self.tau.append(FE_time[ind:]-FE_time[ind])
+                self.FE_vol_os.append(FE_vol_o[ind:])
+                self.FE_flow_os.append(FE_flow_o[ind:])
+                self.del_v.append((FE_vol[-1]-FE_vol[0])-FE_vol_o[ind])
+                self.FE_volume_s.append(FE_vol[ind:])
+                self.FE_flow_s.append(FE_flow[ind:])
+            self.lengths=np.array([len(tau) for tau in self.tau])
+
+        def get_buckets(self,popsize,max_elements,max_padding=1.25):
+            # Group curves of similar length (at most max_padding times the shortest one) so that
+            # a bucket holds at most max_elements samples per (curve x candidate) workspace array
+            order=np.argsort(self.lengths,kind='stable')
+            buckets=[]
+            start=0
+            while start<len(order):
+                stop=start+1
+                while (stop<len(order) and (stop-start+1)*popsize*self.lengths[order[stop]]<=max_elements
+                       and self.lengths[order[stop]]<=max_padding*self.lengths[order[start]]):
+                    stop+=1
+                buckets.append(order[start:stop])
+                start=stop
+            return buckets
+
+        def pad_bucket(self,bucket):
+            # Pad with tau=0 and the initial conditions, where the model matches the signal exactly
+            L=np.max(self.lengths[bucket])
+            tau=np.zeros((len(bucket),L))
+            vol=np.empty((len(bucket),L))
+            flow=np.empty((len(bucket),L))
+            for row,k in enumerate(bucket):
+                n=self.lengths[k]
+                tau[row,:n]=self.tau[k]
+                vol[row,:n]=self.FE_vol_os[k]
+                vol[row,n:]=self.FE_vol_os[k][0]
+                flow[row,:n]=self.FE_flow_os[k]
+                flow[row,n:]=self.FE_flow_os[k][0]
+            return tau,vol,flow
+
+        def Cost_Function_batch(self,wn,zeta,tau,vol,flow):
+            # Cost of P candidates for each of B curves. wn, zeta: (B, P), tau, vol, flow: (B, L)
+            B,P=wn.shape
+            L=tau.shape[1]
+            work=getattr(self,'workspace',None)
+            if work is None or work.size<4*B*P*L:
+                work=np.empty(4*B*P*L)
+                self.workspace=work
+            e1,e2,r,tmp=work[:4*B*P*L].reshape(4,B,P,L)
+            x_t1=vol[:,:1]
+            xdot_t1=flow[:,:1]
+            with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+                sq=np.sqrt(zeta**2-1)
+                s1=(-zeta+sq)*wn
+                s2=(-zeta-sq)*wn
+                s5=2*wn*sq
+                C1=(x_t1*(zeta+sq)*wn+xdot_t1)/s5
+                C2=(-x_t1*(zeta-sq)*wn-xdot_t1)/s5
+                np.multiply(s1[:,:,None],tau[:,None,:],out=e1)
+                np.exp(e1,out=e1)
+                np.multiply(s2[:,:,None],tau[:,None,:],out=e2)
+                np.exp(e2,out=e2)
+
+                # volume residual
+                np.multiply(e1,C1[:,:,None],out=r)
+                np.multiply(e2,C2[:,:,None],out=tmp)
+                r+=tmp
+                r-=vol[:,None,:]
+                J=np.einsum('bpl,bpl->bp',r,r)
+
+                # flow residual
+                np.multiply(e1,(s1*C1)[:,:,None],out=r)
+                np.multiply(e2,(s2*C2)[:,:,None],out=tmp)
+                r+=tmp
+                r-=flow[:,None,:]
+                J+=np.einsum('bpl,bpl->bp',r,r)
+            J[~np.isfinite(J)]=np.inf
+            return J
+
+        def run_differential_evolution(self,tau,vol,flow,lb,ub,rng,popsize,maxiter,mutation,recombination,tol,atol):
+            # best1bin differential evolution run in lockstep for all curves of a bucket
+            B=tau.shape[0]
+            P=popsize*2
+            rows=np.arange(B)[:,None]
+            members=np.arange(P)[None,:]
+
+            # latin hypercube initialization
+            pop=np.empty((B,P,2))
+            for j in range(2):
+                strata=np.argsort(rng.random((B,P)),axis=1)
+                pop[:,:,j]=lb[j]+(ub[j]-lb[j])*(strata+rng.random((B,P)))/P
+            energies=self.Cost_Function_batch(pop[:,:,0],pop[:,:,1],tau,vol,flow)
+            nit=np.zeros(B,dtype=int)
+            converged=np.zeros(B,dtype=bool)
+            active=np.arange(B)
+
+            for itn in range(maxiter):
+                E=energies[active]
+                if np.all(np.isfinite(E)):
+                    done=np.std(E,axis=1)<=atol+tol*np.abs(np.mean(E,axis=1))
+                    converged[active[done]]=True
+                    active=active[~done]
+                if len(active)==0:
+                    break
+                nit[active]+=1
+                b=len(active)
+                p=pop[active]
+                best=p[np.arange(b),np.argmin(energies[active],axis=1)]
+
+                # two distinct random members, different from the target
+                k0=rng.integers(1,P,(b,P))
+                k1=rng.integers(1,P-1,(b,P))
+                k1=k1+(k1>=k0)
+                r0=p[rows[:b],(members+k0)%P]
+                r1=p[rows[:b],(members+k1)%P]
+                F=rng.uniform(mutation[0],mutation[1],(b,1,1)) # dithering per generation
+                trial=best[:,None,:]+F*(r0-r1)
+
+                # binomial crossover
+                cross=rng.random((b,P,2))<recombination
+                cross[rows[:b],members,rng.integers(0,2,(b,P))]=True
+                trial=np.where(cross,trial,p)
+
+                # out of bounds parameters are reinitialized
+                outside=(trial<lb)|(trial>ub)
+                trial=np.where(outside,lb+(ub-lb)*rng.random((b,P,2)),trial)
+
+                E_trial=self.Cost_Function_batch(trial[:,:,0],trial[:,:,1],tau[active],vol[active],flow[active])
+                better=E_trial<energies[active]
+                pop[active]=np.where(better[:,:,None],trial,p)
+                energies[active]=np.where(better,E_trial,energies[active])
+
+            best_index=np.argmin(energies,axis=1)
+            return pop[np.arange(B),best_index], energies[np.arange(B),best_index], nit, converged
+
+        def polish(self,params,J,tau,vol,flow,lb,ub,n_iter=20):
+            # Levenberg-Marquardt steps on the analytic Jacobian, in lockstep for all curves
+            ut=utilities()
+            lam=np.full(len(params),1e-3)
+            for itn in range(n_iter):
+                with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+                    h,h_dash,dh,dh_dash=ut.calc_balloon_jacobian(tau,vol[:,:1],flow[:,:1],params[:,:1],params[:,1:])
+                    g=np.einsum('bli,bl->bi',dh,h-vol)+np.einsum('bli,bl->bi',dh_dash,h_dash-flow)
+                    H=np.einsum('bli,blj->bij',dh,dh)+np.einsum('bli,blj->bij',dh_dash,dh_dash)
+                H=H+lam[:,None,None]*np.eye(2)*np.diagonal(H,axis1=1,axis2=2)[:,:,None]
+                ok=np.all(np.isfinite(H),axis=(1,2))&np.all(np.isfinite(g),axis=1)
+                ok[ok]=np.linalg.det(H[ok])>0
+                step=np.zeros_like(params)
+                step[ok]=np.linalg.solve(H[ok],-g[ok][:,:,None])[:,:,0]
+                trial=np.clip(params+step,lb,ub)
+                J_trial=self.Cost_Function_batch(trial[:,:1],trial[:,1:],tau,vol,flow)[:,0]
+                better=J_trial<J
+                params=np.where(better[:,None],trial,params)
+                J=np.where(better,J_trial,J)
+                lam=np.where(better,lam/3,lam*3)
+            return params, J
+
+        def calc_fit_metrics(self,params,tau,vol,flow,bucket):
+            # mse and R2 of volume and flow after PEF, as reported by deflating_baloon.run_model
+            ut=utilities()
+            with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+                h,h_dash,_,_=ut.calc_balloon_jacobian(tau,vol[:,:1],flow[:,:1],params[:,:1],params[:,1:])
+            for row,k in enumerate(bucket):
+                n=self.lengths[k]
+                # reorient model with RV at max and TLC at 0
+                model_volume=np.abs(h[row,:n]-h[row,0])+self.del_v[k]
+                model_flow=-h_dash[row,:n]
+                FE_volume=self.FE_volume_s[k]
+                FE_flow=self.FE_flow_s[k]
+                self.mse_volume[k]=ut.calc_mse(FE_volume,model_volume)
+                self.mse_flow[k]=ut.calc_mse(FE_flow,model_flow)
+                self.R2_volume[k]=ut.calc_r2_score(FE_volume,model_volume)
+                self.R2_flow[k]=ut.calc_r2_score(FE_flow,model_flow)
+
+        def run_model(self,bounds=[(0,3),(1,6)],popsize=15,maxiter=1000,mutation=(0.5,1),recombination=0.7,
+                      tol=0.01,atol=0,seed=None,polish=True,max_elements=2**22):
+            '''
+            Fits all curves. Results are stored per curve (in input order) as arrays:
+            wn, zeta, cost, mse_volume, mse_flow, R2_volume, R2_flow, nit and converged
+            Curves are bucketed by length so that one (curve x candidate x sample) array
+            holds at most max_elements values
+            '''
+            self.prepare_signals()
+            M=len(self.FE_signals)
+            rng=np.random.default_rng(seed)
+            lb=np.array([bounds[0][0],bounds[1][0]],dtype=float)
+            ub=np.array([bounds[0][1],bounds[1][1]],dtype=float)
+            # zeta=1 and wn=0 are singular in the closed form solution
+            lb_polish=np.array([max(lb[0],1e-6),max(lb[1],1+1e-6)])
+
+            self.wn=np.full(M,np.nan)
+            self.zeta=np.full(M,np.nan)
+            self.cost=np.full(M,np.nan)
+            self.nit=np.zeros(M,dtype=int)
+            self.converged=np.zeros(M,dtype=bool)
+            self.mse_volume=np.full(M,np.nan)
+            self.mse_flow=np.full(M,np.nan)
+            self.R2_volume=np.full(M,np.nan)
+            self.R2_flow=np.full(M,np.nan)
+
+            for bucket in self.get_buckets(2*popsize,max_elements):
+                tau,vol,flow=self.pad_bucket(bucket)
+                params,J,nit,converged=self.run_differential_evolution(tau,vol,flow,lb,ub,rng,popsize,maxiter,
+                                                                       mutation,recombination,tol,atol)
+                if polish:
+                    params=np.clip(params,lb_polish,ub)
+                    J=self.Cost_Function_batch(params[:,:1],params[:,1:],tau,vol,flow)[:,0]
+                    params,J=self.polish(params,J,tau,vol,flow,lb_polish,ub)
+                self.wn[bucket]=params[:,0]
+                self.zeta[bucket]=params[:,1]
+                self.cost[bucket]=J
+                self.nit[bucket]=nit
+                self.converged[bucket]=converged
+                self.calc_fit_metrics(params,tau,vol,flow,bucket)
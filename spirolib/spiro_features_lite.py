@@ -4,9 +4,7 @@ Class to calculate features based on traditional spirometry parameters.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import differential_evolution
-from .utilities import utilities
+from .utilities import utilities, balloon_lut, fit_budget
 
 class spiro_features_lite:
     def __init__(self, volume=None, flow=None):
@@ -179,7 +177,16 @@ class spiro_features_lite:
     
     
     # function to calculate deflating balloon zeta and wn from traditional PEF and FEF params
-    def calc_def_balloon_lite(self, plotModel=False):
+    # solver: "de" (differential evolution), "lsq" (multi-start trust-region least squares),
+    # "analytic" (closed-form linear estimate), "analytic_lsq" (closed-form estimate polished by least squares),
+    # "lut" (nearest fit in a utilities.balloon_lut table) or "lut_lsq" (nearest fit polished by least squares)
+    # lut: optional utilities.balloon_lut, by default a table over the bounds (0,10) x (1,10) shared by all calls
+    # seed, workers, popsize, tol, maxiter: passed to differential_evolution
+    # budget_ms, max_nfev: with the "de" solver, stop with the best solution found so far once the budget
+    # is used up (see utilities.fit_budget). self.balloon_converged is False if the fit stopped early
+    # cache: optional utilities.result_cache, reused when the upsampled signal and solver are unchanged
+    def calc_def_balloon_lite(self, plotModel=False, solver="de", cache=None, lut=None,
+                              seed=None, workers=1, popsize=15, tol=0.01, maxiter=1000, budget_ms=None, max_nfev=None):
          index_PEF = np.argmax(self.flow_us)
          volume= self.volume_us[index_PEF:]
          volume = volume- volume[0]
@@ -219,18 +226,62 @@ class spiro_features_lite:
             
             return h,h_dash
          
-         def Cost_Function(param):
-             ## Compute hypothesis
-             h, h_dash=calc_hypothesis(param)
+         if solver not in ["de","lsq","analytic","analytic_lsq","lut","lut_lsq"]:
+             raise Exception('Unknown solver: '+str(solver))
+         budget=fit_budget(budget_ms,max_nfev)
+         if budget.is_active() and solver!="de":
+             raise Exception('budget_ms and max_nfev require the de solver')
+         if solver in ["lut","lut_lsq"] and lut is None:
+             lut=balloon_lut.get_default((0,10),(1,10),time[-1]-time[0])
+         if cache is not None:
+             settings={'solver':solver, 'seed':seed, 'popsize':popsize, 'tol':tol, 'maxiter':maxiter,
+                       'budget':budget.is_active()}
+             if solver in ["lut","lut_lsq"]:
+                 settings['lut']=lut.settings
+             key=cache.get_key('spiro_features_lite.calc_def_balloon_lite', [time, volume, flow], settings)
+             cached=cache.get(key)
+         if cache is not None and cached is not None:
+             w,zeta,J=cached
+         elif solver=="lsq":
+             # trust-region least squares with the analytic Jacobian, multi-start
+             ut=utilities()
+             w,zeta,J,_=ut.fit_balloon_lsq(time-time[0],volume,flow,volume[0],flow[0],bounds=[(0,10),(1,10)])
+         elif solver in ["analytic","analytic_lsq"]:
+             # one linear solve on the integral form of the model, optionally polished
+             ut=utilities()
+             w,zeta,J,_=ut.fit_balloon_analytic(time-time[0],volume,flow,volume[0],flow[0],bounds=[(0,10),(1,10)],
+                                                refine=solver=="analytic_lsq")
+         elif solver in ["lut","lut_lsq"]:
+             # score every grid point of the table at once, optionally polished
+             w,zeta,J,_=lut.fit(time-time[0],volume,flow,volume[0],flow[0],refine=solver=="lut_lsq")
+         elif solver=="de":
+             import functools
+             from scipy.optimize import differential_evolution
+             # cost J=sum((h-volume)**2)+sum((h_dash-flow)**2), one candidate per call (picklable for
+             # process pools). With a seed or workers the whole population is scored at once (one
+             # candidate per call with workers) with deferred updating, which makes a seeded fit
+             # independent of workers. Otherwise the immediate updating of the original fit is kept
+             ut=utilities()
+             cost=functools.partial(ut.calc_balloon_cost,tau=time-time[0],vol=volume,flow=flow,
+                                    x_t1=volume[0],xdot_t1=flow[0])
+             if seed is None and workers==1:
+                 updating={}
+             else:
+                 updating={'vectorized':workers==1,'updating':'deferred'}
+             population=fit_budget.get_population(popsize,2) if workers==1 and updating else 1
+             param_final=differential_evolution(cost,bounds=[(0,10),(1,10)],strategy='best1bin',seed=seed,
+                                                workers=workers,popsize=popsize,tol=tol,maxiter=maxiter,
+                                                callback=budget.get_callback(population) if budget.is_active() else None,
+                                                polish=not budget.is_active(),**updating)
+             budget.add_result(param_final,population)
              
-             # Caculate J
-             J=np.sum((h - volume)**2)+np.sum((h_dash - flow)**2)
-             return J
-           
-         param_final=differential_evolution(Cost_Function,bounds=[(0,10),(1,10)],strategy='best1bin')
-         
-         w=param_final.x[0]
-         zeta=param_final.x[1]
+             w=param_final.x[0]
+             zeta=param_final.x[1]
+             J=param_final.fun
+         self.balloon_cost=J # cost reached by the solver
+         self.balloon_converged=budget.converged
+         if cache is not None and cached is None and not budget.stopped:
+             cache.put(key, (w, zeta, J))
 
          if plotModel:
              h,h_dash=calc_hypothesis([w, zeta])
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+A container for many spirometry signals stored in flat arrays.
+"""
+
+import types
+import numpy as np
+from .spiro_signal_process import spiro_signal_process
+
+# Per-curve numeric columns, NaN until known
+param_columns = ['FEV1', 'FVC', 'Tiff', 'PEF', 'FEF25', 'FEF50', 'FEF75', 'FEF25_75',
+                 'FEV1_PerPred', 'FVC_PerPred', 'Tiff_PerPred', 'PEF_PerPred', 'FEF25_PerPred',
+                 'FEF50_PerPred', 'FEF75_PerPred', 'FEF25_75_PerPred', 'Sex', 'Age', 'Height']
+
+class spiro_signal_batch:
+    def __init__(self, signals, trialID="Best", flag_given_signal_is_FE=True):
+        '''
+        Stores the time, volume and flow of all curves in three contiguous buffers. Curve i
+        occupies samples offsets[i]:offsets[i+1]. Per-curve metadata is kept column-wise
+        Requires:
+        1. signals: either a dictionary {patientID: [Time, Volume, Flow]} or {patientID: sp},
+           or a list of spiro_signal_process objects (sp)
+        2. trialID: trial ID used for [Time, Volume, Flow] entries
+        3. flag_given_signal_is_FE: used for [Time, Volume, Flow] entries
+        The patient ID, trial ID, FE flag, index1/index2 and finalized parameters of
+        spiro_signal_process objects are taken over
+        '''
+        if isinstance(signals, dict):
+            items=list(signals.items())
+        else:
+            items=[(sp.patientID, sp) for sp in signals]
+        n=len(items)
+
+        self.patientID=np.empty(n, dtype=object)
+        self.trialID=np.empty(n, dtype=object)
+        self.flag_given_signal_is_FE=np.zeros(n, dtype=bool)
+        self.index1=np.full(n, -1, dtype=np.int64) # -1: not determined
+        self.index2=np.full(n, -1, dtype=np.int64)
+        self.columns={col:np.full(n, np.nan) for col in param_columns}
+        self.signal_finalized=np.zeros(n, dtype=bool)
+
+        time_list, volume_list, flow_list = [], [], []
+        for i, (patID, data) in enumerate(items):
+            if isinstance(data, spiro_signal_process):
+                time, volume, flow = data.time, data.volume, data.flow
+                self.patientID[i]=data.patientID
+                self.trialID[i]=data.trialID
+                self.flag_given_signal_is_FE[i]=data.flag_given_signal_is_FE
+                if getattr(data, 'index1', None) is not None:
+                    self.index1[i]=data.index1
+                if getattr(data, 'index2', None) is not None:
+                    self.index2[i]=data.index2
+                self.signal_finalized[i]=data.signal_finalized
+                for col in param_columns:
+                    if hasattr(data, col):
+                        self.columns[col][i]=getattr(data, col)
+            else:
+                time, volume, flow = data[0], data[1], data[2]
+                self.patientID[i]=str(patID)
+                self.trialID[i]=str(trialID)
+                self.flag_given_signal_is_FE[i]=flag_given_signal_is_FE
+            if (len(time)!=len(volume)) or (len(volume)!=len(flow)):
+                raise Exception('Length of time, volume and flow vectors do not match for '+str(patID))
+            time_list.append(time)
+            volume_list.append(volume)
+            flow_list.append(flow)
+
+        lengths=np.array([len(t) for t in time_list], dtype=np.int64)
+        self.offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.time=np.concatenate(time_list).astype(float) if n>0 else np.zeros(0)
+        self.volume=np.concatenate(volume_list).astype(float) if n>0 else np.zeros(0)
+        self.flow=np.concatenate(flow_list).astype(float) if n>0 else np.zeros(0)
+        self._lookup=None
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    @property
+    def lengths(self):
+        # Number of samples of each curve
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        # Memory used by the sample buffers and numeric columns
+        return (self.time.nbytes+self.volume.nbytes+self.flow.nbytes+self.offsets.nbytes
+                +self.index1.nbytes+self.index2.nbytes+sum(c.nbytes for c in self.columns.values()))
+
+    def get_indexes(self, patientID):
+        # Positions of the curves of a patient (all trials)
+        if self._lookup is None:
+            self._lookup={}
+            for i, patID in enumerate(self.patientID):
+                self._lookup.setdefault(patID, []).append(i)
+        return self._lookup.get(str(patientID), [])
+
+    def get_curve(self, i):
+        # time, volume and flow of curve i (views into the buffers)
+        s, e = self.offsets[i], self.offsets[i+1]
+        return self.time[s:e], self.volume[s:e], self.flow[s:e]
+
+    def get_signal(self, i):
+        '''
+        Presents curve i as a spiro_signal_process object without copying the samples
+        Note: the arrays are views into the batch buffers, so in-place modifications
+        (e.g. utilities.add_noise_to_FVLdata) also change the batch. Methods that
+        replace time, volume or flow (e.g. shift_TLC_to_orgin) do not
+        '''
+        time, volume, flow = self.get_curve(i)
+        sp=spiro_signal_process.__new__(spiro_signal_process)
+        state={'time':time, 'volume':volume, 'flow':flow,
+               'patientID':str(self.patientID[i]), 'trialID':str(self.trialID[i]),
+               'flag_given_signal_is_FE':bool(self.flag_given_signal_is_FE[i]),
+               'signal_finalized':bool(self.signal_finalized[i]),
+               'index1':int(self.index1[i]) if self.index1[i]>=0 else None,
+               'index2':int(self.index2[i]) if self.index2[i]>=0 else None}
+        for col in param_columns:
+            if not np.isnan(self.columns[col][i]):
+                state[col]=self.columns[col][i]
+        sp.__setstate__(state)
+        return sp
+
+    def set_signal_parameters(self, i, sp):
+        # Stores index1/index2 and finalized parameters of sp in the columns of curve i
+        if getattr(sp, 'index1', None) is not None:
+            self.index1[i]=sp.index1
+        if getattr(sp, 'index2', None) is not None:
+            self.index2[i]=sp.index2
+        self.signal_finalized[i]=sp.signal_finalized
+        for col in param_columns:
+            if hasattr(sp, col):
+                self.columns[col][i]=getattr(sp, col)
+
+    def to_dataframe(self):
+        # Per-curve metadata and parameters as a dataframe (one row per curve)
+        import pandas as pd
+        df=pd.DataFrame({'patientID':self.patientID, 'trialID':self.trialID,
+                         'flag_given_signal_is_FE':self.flag_given_signal_is_FE,
+                         'n_samples':self.lengths, 'index1':self.index1, 'index2':self.index2,
+                         'signal_finalized':self.signal_finalized})
+        for col in param_columns:
+            df[col]=self.columns[col]
+        return df
+
+    def segment_reduce(self, ufunc, values, fill):
+        # ufunc reduction of a flat array over each curve (fill for empty curves)
+        lengths=self.lengths
+        out=np.full(len(lengths), fill, dtype=np.result_type(values, type(fill)))
+        nonempty=lengths>0
+        if np.any(nonempty):
+            out[nonempty]=ufunc.reduceat(values, self.offsets[:-1][nonempty])
+        return out
+
+    def calc_ECCS93_ref(self, param, sex, age, height):
+        # spiro_signal_process.calc_ECCS93_ref for arrays of sex, age and height
+        male=spiro_signal_process.calc_ECCS93_ref(types.SimpleNamespace(Sex=1, Age=age, Height=height), param)
+        female=spiro_signal_process.calc_ECCS93_ref(types.SimpleNamespace(Sex=0, Age=age, Height=height), param)
+        return np.where(sex==1, male, female)
+
+    def calc_FE_parameters(self, todo):
+        # Shifts TLC to origin and computes FEV1, FVC, Tiff, PEF, FEF25/50/75 and FEF25-75
+        # of the curves in todo. ok marks the curves for which all of them exist
+        N=len(self.time)
+        starts=self.offsets[:-1]
+        lengths=self.lengths
+        curve=np.repeat(np.arange(len(self)), lengths)
+        pos=np.arange(N)
+        # flat positions of index1 and index2 (clamped for the curves not processed)
+        g1=np.minimum(starts+np.maximum(self.index1, 0), max(N-1, 0))
+        g2=np.minimum(starts+np.maximum(self.index2, 0), max(N-1, 0))
+        
+        # shift TLC to origin, into a new buffer so that signals obtained earlier with
+        # get_signal keep the volume their cached segmentation was computed on
+        shift=todo[curve]
+        volume=np.array(self.volume, dtype=float)
+        volume[shift]-=volume[g1][curve[shift]]
+        self.volume=volume
+        time, flow = self.time, self.flow
+        
+        # FEV1 and FVC: first sample more than 1 s after index1
+        after_1s=(pos>=g1[curve]) & ((time-time[g1][curve])>1) & shift
+        j1=self.segment_reduce(np.minimum, np.where(after_1s, pos, N), N)
+        ok=todo & (j1<=g2) & (j1>g1)
+        j1=np.where(ok, j1, g1)
+        j0=np.where(ok, j1-1, g1)
+        xp0=time[j0]-time[g1]
+        xp1=time[j1]-time[g1]
+        FEV1=np.where(xp0==1, volume[j0], (volume[j1]-volume[j0])/(xp1-xp0)*(1-xp0)+volume[j0])
+        FVC=np.abs(volume[g2]-volume[g1])
+        
+        # flow parameters over the FE part (whole signal if it is FE only)
+        a=np.where(self.flag_given_signal_is_FE, starts, g1)
+        b=np.where(self.flag_given_signal_is_FE, starts+lengths-1, g2)
+        in_FE=(pos>=a[curve]) & (pos<=b[curve]) & shift
+        PEF=self.segment_reduce(np.maximum, np.where(in_FE, flow, -np.inf), -np.inf)
+        norm_c=volume[b]
+        vol_norm=np.where(in_FE, volume/norm_c[curve], np.nan)
+        # search stops at the first sample above FVC
+        over=self.segment_reduce(np.minimum, np.where(vol_norm>1, pos, N), N)
+        last=np.minimum(over, b)
+        
+        fractions=[0.25, 0.5, 0.75]
+        v0, v1 = vol_norm[:-1], vol_norm[1:]
+        valid=in_FE[:-1] & (pos[1:]<=last[curve[:-1]])
+        # crossing of the largest fraction, then the last crossing of each fraction before it
+        top=valid & (v0<fractions[-1]) & (v1>=fractions[-1])
+        stop=self.segment_reduce(np.minimum, np.append(np.where(top, pos[:-1], N), N), N)
+        FEF, time_FEF = [], []
+        for q in fractions:
+            cross=valid & (v0<q) & (v1>=q) & (pos[:-1]<=stop[curve[:-1]])
+            indx=self.segment_reduce(np.maximum, np.append(np.where(cross, pos[:-1], -1), -1), -1)
+            ok&=(indx>=0)
+            indx=np.where(indx>=0, indx, np.minimum(a, max(N-2, 0)))
+            vn0, vn1 = vol_norm[indx], vol_norm[indx+1]
+            at_end=(vn1==q)
+            FEF.append(np.where(at_end, flow[indx+1], (flow[indx+1]-flow[indx])/(vn1-vn0)*(q-vn0)+flow[indx]))
+            time_FEF.append(np.where(at_end, time[indx+1], (time[indx+1]-time[indx])/(vn1-vn0)*(q-vn0)+time[indx]))
+        FEF_25_75=(0.5*norm_c)/(time_FEF[2]-time_FEF[0])
+        
+        values={'FEV1':FEV1, 'FVC':FVC, 'PEF':PEF, 'FEF25':FEF[0], 'FEF50':FEF[1],
+                'FEF75':FEF[2], 'FEF25_75':FEF_25_75}
+        for col in values:
+            values[col]=np.round(values[col], 2)
+        values['Tiff']=100*values['FEV1']/values['FVC']
+        return values, ok
+
+    def finalize_signals(self, sex=None, age=None, height=None):
+        '''
+        Batch version of spiro_signal_process.finalize_signal for all curves with known
+        index1 and index2, computed with segmented reductions over the flat buffers
+        Inputs:
+        1. sex (1:male or 0:female), age (years), height (cm): scalars or per-curve arrays
+           (NaN if unknown). If not given, the Sex, Age and Height columns are used
+        As in finalize_signal, the volume of each curve is shifted so that it is 0 at
+        index1 (the volume buffer is replaced, signals obtained before with get_signal or
+        get_curve keep the unshifted volume), parameters already computed are kept and the %pred values are
+        (re)computed where sex, age and height are known. Curves whose parameters cannot
+        be computed (e.g. FE shorter than 1 s) are left unfinalized with NaN values
+        Returns the dictionary of parameter columns
+        '''
+        cols=self.columns
+        todo=(self.index1>=0) & (self.index2>=self.index1) & (self.index2<self.lengths) & np.isnan(cols['FEV1'])
+        if np.any(todo):
+            with np.errstate(all='ignore'):
+                values, ok = self.calc_FE_parameters(todo)
+            done=todo & ok
+            for col in values:
+                cols[col][done]=values[col][done]
+            self.signal_finalized|=done
+        
+        # reference values
+        if (sex is not None) and (age is not None) and (height is not None):
+            cols['Sex'][:]=sex
+            cols['Age'][:]=age
+            cols['Height'][:]=height
+        known=np.isfinite(cols['FEV1']) & np.isfinite(cols['Sex']) & np.isfinite(cols['Age']) & np.isfinite(cols['Height'])
+        if np.any(known):
+            sex, age, height = cols['Sex'][known], cols['Age'][known], cols['Height'][known]
+            with np.errstate(all='ignore'):
+                for param in ['FEV1', 'FVC', 'Tiff', 'PEF', 'FEF25', 'FEF50', 'FEF75', 'FEF25_75']:
+                    ref=self.calc_ECCS93_ref(param, sex, age, height)
+                    cols[param+'_PerPred'][known]=np.round(100*cols[param][known]/ref, 2)
+        return cols
+
+    def save(self, path):
+        # Writes the batch to a spiro_signal_store directory
+        spiro_signal_store(path).write(self)
+
+
+class spiro_signal_store:
+    # On-disk layout of a spiro_signal_batch: a directory with one .npy file per buffer and
+    # metadata column, plus store.json. Files are read memory-mapped, so only the curves
+    # that are used are loaded from disk
+    version=1
+
+    def __init__(self, path):
+        self.path=path
+        self._arrays={}
+
+    def file(self, name):
+        import os
+        return os.path.join(self.path, name+'.npy')
+
+    def write(self, batch):
+        # The files are written into a temporary sibling directory that then replaces the
+        # store, so readers never see a mix of old and new files
+        import os
+        import json
+        import shutil
+        import tempfile
+        path=os.path.abspath(self.path)
+        parent, name=os.path.split(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path=tempfile.mkdtemp(prefix='.'+name+'.tmp', dir=parent)
+        arrays={'time':batch.time, 'volume':batch.volume, 'flow':batch.flow, 'offsets':batch.offsets,
+                'index1':batch.index1, 'index2':batch.index2,
+                'flag_given_signal_is_FE':batch.flag_given_signal_is_FE,
+                'signal_finalized':batch.signal_finalized,
+                'patientID':np.array([str(x) for x in batch.patientID], dtype=str),
+                'trialID':np.array([str(x) for x in batch.trialID], dtype=str)}
+        for col in param_columns:
+            arrays['col_'+col]=batch.columns[col]
+        # sorted patient IDs for lookups by binary search
+        order=np.argsort(arrays['patientID'], kind='stable')
+        arrays['patientID_order']=order
+        arrays['patientID_sorted']=arrays['patientID'][order]
+        try:
+            for key in arrays:
+                np.save(os.path.join(tmp_path, key+'.npy'), np.asarray(arrays[key]), allow_pickle=False)
+            # written last: a store without store.json is incomplete
+            with open(os.path.join(tmp_path, 'store.json'), 'w') as f:
+                json.dump({'version':self.version, 'n_curves':len(batch), 'n_samples':len(batch.time),
+                           'columns':param_columns}, f)
+            if os.path.exists(path):
+                # a non-empty directory cannot be replaced directly, move the old store aside first
+                old_path=tempfile.mkdtemp(prefix='.'+name+'.old', dir=parent)
+                os.replace(path, os.path.join(old_path, name))
+                os.replace(tmp_path, path)
+                shutil.rmtree(old_path, ignore_errors=True)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self._arrays={}
+
+    def get_array(self, name, mmap_mode='r'):
+        if (name, mmap_mode) not in self._arrays:
+            self._arrays[(name, mmap_mode)]=np.load(self.file(name), mmap_mode=mmap_mode, allow_pickle=False)
+        return self._arrays[(name, mmap_mode)]
+
+    def read(self, mmap_mode='r'):
+        '''
+        Returns the stored spiro_signal_batch with memory-mapped buffers
+        Inputs:
+        1. mmap_mode: 'r' (read-only), 'c' (copy-on-write, needed for finalize_signals
+           and other in-place changes, which are not written to disk) or None (load into memory)
+        '''
+        import os
+        import json
+        with open(os.path.join(self.path, 'store.json')) as f:
+            info=json.load(f)
+        if info['version']>self.version:
+            raise Exception('Store version '+str(info['version'])+' is not supported')
+        batch=spiro_signal_batch.__new__(spiro_signal_batch)
+        for name in ['time', 'volume', 'flow', 'offsets', 'index1', 'index2',
+                     'flag_given_signal_is_FE', 'signal_finalized', 'patientID', 'trialID']:
+            setattr(batch, name, self.get_array(name, mmap_mode))
+        batch.columns={col:self.get_array('col_'+col, mmap_mode) for col in info['columns']}
+        batch._lookup=None
+        return batch
+
+    def get_indexes(self, patientID):
+        # Curve positions of a patient, found by binary search in the sorted IDs
+        sorted_IDs=self.get_array('patientID_sorted')
+        lo=np.searchsorted(sorted_IDs, str(patientID), side='left')
+        hi=np.searchsorted(sorted_IDs, str(patientID), side='right')
+        return np.sort(self.get_array('patientID_order')[lo:hi])
+
+    def get_signals(self, patientID):
+        # All curves (trials) of a patient as spiro_signal_process objects backed by the store
+        batch=self.read()
+        return [batch.get_signal(i) for i in self.get_indexes(patientID)]
+
+    def import_pickle(self, pickle_path):
+        # Converts a pickled {patientID: sp} dictionary into this store
+        import pickle
+        with open(pickle_path, 'rb') as f:
+            FVLData=pickle.load(f)
+        self.write(spiro_signal_batch(FVLData))
+
+    def export_pickle(self, pickle_path):
+        # Writes the store as a pickled {patientID: sp} dictionary (arrays copied into memory)
+        import pickle
+        batch=self.read()
+        FVLData={}
+        for i in range(len(batch)):
+            sp=batch.get_signal(i)
+            if sp.patientID in FVLData:
+                raise Exception('Patient '+sp.patientID+' has more than one curve, cannot export as {patientID: sp}')
+            sp.time, sp.volume, sp.flow = np.array(sp.time), np.array(sp.volume), np.array(sp.flow)
+            sp.patientID, sp.trialID = str(sp.patientID), str(sp.trialID)
+            FVLData[sp.patientID]=sp
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(FVLData, f)
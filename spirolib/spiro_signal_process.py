@@ -3,10 +3,9 @@
 A class to perform various operations on spirometry data signals.
 """
 
-import peakutils
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.signal import butter, lfilter
+# matplotlib, peakutils and scipy.signal are imported where they are used
+# to keep "import spirolib" light
 
 
 # Important: consistently followed: index0= start of FI, index1 =start of FE, index2=end of FE
@@ -40,6 +39,50 @@ class spiro_signal_process:
         self.index1 = None 
         self.index2 = None 
 
+    # time, volume and flow are properties so that cached FE segmentation results
+    # are dropped whenever one of the signals is replaced
+    @property
+    def time(self):
+        return self._time
+
+    @time.setter
+    def time(self,value):
+        self._time=value
+        self.clear_FE_cache()
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self,value):
+        self._volume=value
+        self.clear_FE_cache()
+
+    @property
+    def flow(self):
+        return self._flow
+
+    @flow.setter
+    def flow(self,value):
+        self._flow=value
+        self.clear_FE_cache()
+
+    def clear_FE_cache(self):
+        # Drops cached results of get_FE_start_end and the time index. Call this
+        # after modifying time, volume or flow in place (e.g. sp.flow[i]=...)
+        self._FE_cache={}
+        self._time_index=None
+
+    def __setstate__(self,state):
+        # objects pickled before time, volume and flow became properties
+        for key in ['time','volume','flow']:
+            if key in state:
+                state['_'+key]=state.pop(key)
+        state['_FE_cache']={}
+        state['_time_index']=None
+        self.__dict__.update(state)
+
         
     def correct_data_positioning(self,flip_vol=False,flip_flow=False):
         '''
@@ -69,6 +112,7 @@ class spiro_signal_process:
         4. only_FE: A boolean indicating if only the forced expiratory manoeuvre needs to be displayed
         ......
         '''
+        import matplotlib.pyplot as plt
         if show_ID:
             if add_text=="":
                 title_str=self.patientID+'-'+ self.trialID
@@ -139,12 +183,51 @@ class spiro_signal_process:
         
         #plt.close(plt.Figure)
         
+    def get_time_index(self):
+        # Lazily built description of the time axis used by get_Indexes_In_time
+        if self._time_index is None:
+            time=np.asarray(self.time)
+            dt=np.diff(time)
+            monotone=bool(np.all(dt>=0))
+            step=(time[-1]-time[0])/(len(time)-1) if len(time)>1 else 0
+            uniform=bool(monotone and step>0 and np.allclose(dt,step,rtol=1e-6,atol=0))
+            self._time_index={'uniform':uniform,'monotone':monotone,'t0':time[0] if len(time) else 0,'dt':step}
+        return self._time_index
+    
+    def get_Indexes_In_time(self, t_offset, start_index=0):
+        '''
+        Index (relative to start_index) of the last sample within t_offset seconds of start_index
+        i.e. one before the first sample with time-time[start_index] > t_offset
+        Inputs:
+            1. t_offset: time offset in seconds (e.g. 0.5, 1, 3, 6)
+            2. start_index: index the offset is measured from
+        Returns -1 when the signal ends before t_offset
+        Uniform sampling: O(1) lookup, monotone time: O(log n) searchsorted
+        '''
+        time=self.time
+        n=len(time)
+        t_start=time[start_index]
+        index=self.get_time_index()
+        if index['uniform']:
+            k=start_index+int(np.floor(t_offset/index['dt']))+1
+            k=min(max(k,start_index),n)
+        elif index['monotone']:
+            k=int(np.searchsorted(time,t_start+t_offset,side='right'))
+            k=max(k,start_index)
+        else:
+            later=np.flatnonzero((time[start_index:]-t_start)>t_offset)
+            return int(later[0])-1 if later.size else -1
+        # correct rounding of the guess against the exact criterion
+        while k>start_index and (time[k-1]-t_start)>t_offset:
+            k-=1
+        while k<n and not (time[k]-t_start)>t_offset:
+            k+=1
+        if k>=n:
+            return -1
+        return k-start_index-1
+    
     def get_Indexes_In_1s(self, start_index=0):
-        time=self.time[start_index:]
-        time=time-time[0]
-        new_list = list(time-1)
-        indexes_1s = next(t[0] for t in enumerate(new_list) if t[1] > 0)
-        return indexes_1s - 1
+        return self.get_Indexes_In_time(1, start_index=start_index)
     
     def get_PEF_index(self, indx1,indx2):
         flow=self.flow
@@ -154,12 +237,14 @@ class spiro_signal_process:
         return PEF_index
     
     def butter_lowpass(self,cutoff, fs, order):
+        from scipy.signal import butter
         nyq = 0.5 * fs
         normal_cutoff = cutoff / nyq
         b, a = butter(order, normal_cutoff, btype='low', analog=False)
         return b, a
 
     def butter_lowpass_filter(self,data, cutoff, fs, order):
+        from scipy.signal import lfilter
         b, a = self.butter_lowpass(cutoff, fs, order=order)
         y = lfilter(b, a, data)
         return y
@@ -195,14 +280,12 @@ class spiro_signal_process:
         
         
         # to get index corresponding to t_ep 
-        temp_index=0
         if t_ep>=0:
-            while temp_index<len(time)-1:
-                if t_ep>= time[temp_index] and t_ep<time[temp_index+1]:
-                    new_index1 = temp_index
-                    break
-                else:
-                    temp_index=temp_index+1
+            # first sample interval [time[i], time[i+1]) containing t_ep
+            in_interval=(time[:-1]<=t_ep) & (t_ep<time[1:])
+            if not in_interval.any():
+                raise Exception('Back extrapolated start time lies beyond the end of the FE signal')
+            new_index1=int(np.argmax(in_interval))
                     
             FVC = abs(vol[-1] - vol[0])
             BEV = vol[new_index1]
@@ -239,10 +322,9 @@ class spiro_signal_process:
         
         threshold=(thresh_percent_begin/100)*PEF #Any flow below this is zero, thresh_percent of PEF
         
-        temp_index1=int(len(flow_excit)-1)
-        
-        while flow_excit[temp_index1]>threshold and temp_index1>0:#index1:
-            temp_index1=temp_index1-1
+        # last sample (excluding the first) at or below threshold before PEF
+        below=np.flatnonzero(flow_excit[1:]<=threshold)
+        temp_index1=int(below[-1])+1 if below.size else 0
         
         index1=index1+temp_index1+1
         
@@ -264,9 +346,9 @@ class spiro_signal_process:
         PEF=flow[PEF_Index]
         threshold=(thresh_percent_end/100)* PEF
 
-        temp_index2=index2
-        while (temp_index2>index1) and (flow[temp_index2]<=threshold):
-            temp_index2 = temp_index2 - 1
+        # last sample after index1 above threshold
+        above=np.flatnonzero(flow[index1+1:index2+1]>threshold)
+        temp_index2=index1+int(above[-1])+1 if above.size else index1
         
         return temp_index2
     
@@ -275,7 +357,14 @@ class spiro_signal_process:
         #indx2 is end of FE or point of RV
         #IMPORTANT: Assumes data is positioned and standerdized
         # default start type of FE is BEV
-        
+        # Results are cached per set of arguments until time, volume or flow are replaced
+        key=(start_type, thresh_percent_begin, thresh_percent_end, check_BEV_criteria, self.flag_given_signal_is_FE)
+        if key not in self._FE_cache:
+            self._FE_cache[key]=self.calc_FE_start_end(start_type, thresh_percent_begin, thresh_percent_end, check_BEV_criteria)
+        return self._FE_cache[key]
+    
+    def calc_FE_start_end(self, start_type=None, thresh_percent_begin = 2, thresh_percent_end =0.5 ,check_BEV_criteria = False):
+        # Segmentation behind get_FE_start_end, without caching
         if self.flag_given_signal_is_FE:
             if start_type is None:
                 index1=0
@@ -295,8 +384,11 @@ class spiro_signal_process:
             
             return index1, index2
         else:
+            import peakutils
             volume=self.volume
             indx_1s=self.get_Indexes_In_1s()
+            if indx_1s<0:
+                raise Exception('Signal is shorter than 1 s, FE start and end cannot be found')
             
             indx1=np.argmin(volume) 
             VolVec_aft_TLC=volume[indx1+1:] #Volume vector from TLC to end
@@ -363,6 +455,8 @@ class spiro_signal_process:
         #plt.plot(FEtime,FE_Vol)    
         t0=FE_time[0]
         index_1s=self.get_Indexes_In_1s(start_index=self.index1)
+        if index_1s<0 or index_1s+1>=len(FE_time):
+            raise Exception('FE signal is shorter than 1 s, FEV1 cannot be calculated')
         FEV1=np.interp(t0+1, [FE_time[index_1s],FE_time[index_1s+1]], [FE_Vol[index_1s],FE_Vol[index_1s+1]])       
 
         FVC=abs(FE_Vol[-1]-FE_Vol[0])
@@ -371,37 +465,61 @@ class spiro_signal_process:
     
     def calc_flow_parameters(self):
         # Only possible when index1 and index2 are determined
-         if self.flag_given_signal_is_FE:
-             FEvol=self.volume
-             FEflow=self.flow
-             FEtime=self.time
-         else:
-            FEvol=self.volume[self.index1:self.index2+1]
-            FEflow=self.flow[self.index1:self.index2+1]
-            FEtime=self.time[self.index1:self.index2+1]
-             
-         norm_c=FEvol[-1] # or FVC
-         FEvol_norm=FEvol/norm_c
-         PEFindx=np.argmax(FEflow)
-         PEF=FEflow[PEFindx]
-         indx=0
-                #print(indx)
-         while FEvol_norm[indx]<=1:
-            if FEvol_norm[indx+1]>=0.25 and FEvol_norm[indx]<0.25:
-                FEF25=np.interp(0.25,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEflow[indx],FEflow[indx+1]])
-                time25=np.interp(0.25,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEtime[indx],FEtime[indx+1]])
-                        
-            if FEvol_norm[indx+1]>=0.5 and FEvol_norm[indx]<0.5:
-                FEF50=np.interp(0.5,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEflow[indx],FEflow[indx+1]])
-                    
-            if FEvol_norm[indx+1]>=0.75 and FEvol_norm[indx]<0.75:
-                FEF75=np.interp(0.75,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEflow[indx],FEflow[indx+1]])
-                time75=np.interp(0.75,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEtime[indx],FEtime[indx+1]])
-                break
-            indx+=1
-            
-         FEF_25_75=(0.5*norm_c)/(time75-time25)
-         return round(PEF,2), round(FEF25,2), round(FEF50,2), round(FEF75,2), round(FEF_25_75,2)
+        FEvol, FEflow, FEtime = self.get_FE_vol_flow_time()
+        norm_c=FEvol[-1] # or FVC
+        PEF=FEflow[np.argmax(FEflow)]
+        (FEF25, FEF50, FEF75), (time25, time50, time75) = self.calc_FEF_percentiles([0.25, 0.5, 0.75])
+        FEF_25_75=(0.5*norm_c)/(time75-time25)
+        return round(PEF,2), round(FEF25,2), round(FEF50,2), round(FEF75,2), round(FEF_25_75,2)
+    
+    def get_FE_vol_flow_time(self):
+        # FE part of volume, flow and time (index1 and index2 must be determined)
+        if self.flag_given_signal_is_FE:
+            return self.volume, self.flow, self.time
+        return (self.volume[self.index1:self.index2+1], self.flow[self.index1:self.index2+1],
+                self.time[self.index1:self.index2+1])
+    
+    def calc_FEF_percentiles(self, fractions=[0.25, 0.5, 0.75]):
+        '''
+        Flow and time at which given fractions of the FE volume have been exhaled
+        e.g. fractions=np.arange(0.1,1,0.1) for FEF10...FEF90
+        Inputs:
+            1. fractions: list of volume fractions (of FVC) between 0 and 1
+        Returns arrays (FEF, time) in the order of fractions
+        Crossings are searched up to the crossing of the largest fraction, as
+        the sample by sample search did
+        '''
+        FEvol, FEflow, FEtime = self.get_FE_vol_flow_time()
+        FEvol_norm=FEvol/FEvol[-1]
+        q=np.asarray(fractions, dtype=float)
+        # search stops at the first sample above FVC
+        over=np.flatnonzero(FEvol_norm>1)
+        v=FEvol_norm[:over[0]+1] if over.size else FEvol_norm
+        
+        if np.all(v[1:]>=v[:-1]):
+            # monotone volume: each fraction is crossed once, v[i]<q<=v[i+1]
+            indx=np.searchsorted(v, q, side='left')-1
+            found=(indx>=0) & (indx<len(v)-1)
+        else:
+            # crossings of every fraction; keep the last one before the largest fraction is crossed
+            cross=(v[:-1,None]<q) & (v[1:,None]>=q)
+            top=cross[:,np.argmax(q)]
+            stop=np.argmax(top) if top.any() else len(v)-2
+            cross=cross[:stop+1]
+            found=cross.any(axis=0)
+            indx=stop-np.argmax(cross[::-1], axis=0)
+        if not np.all(found):
+            raise Exception('Volume fractions ' + str(q[~found]) + ' not reached in FE signal')
+        
+        # two point linear interpolation, as np.interp evaluates it
+        v0, v1 = v[indx], v[indx+1]
+        frac=q-v0
+        FEF=(FEflow[indx+1]-FEflow[indx])/(v1-v0)*frac+FEflow[indx]
+        time_FEF=(FEtime[indx+1]-FEtime[indx])/(v1-v0)*frac+FEtime[indx]
+        at_end=(q==v1)
+        FEF[at_end]=FEflow[indx+1][at_end]
+        time_FEF[at_end]=FEtime[indx+1][at_end]
+        return FEF, time_FEF
         
          
      
@@ -416,7 +534,10 @@ class spiro_signal_process:
         if len(vol_before_FE)==0:
             return -1
         
+        import peakutils
         indx_1s=self.get_Indexes_In_1s()
+        if indx_1s<0:
+            return -1
         thresh=0.3
         peaks=peakutils.indexes(vol_before_FE, thres=thresh, min_dist=int(indx_1s))
         #plt.plot(self.time[0:index1],vol_before_FE)
@@ -649,6 +770,7 @@ class spiro_signal_process:
             FE_vol = np.append(FE_vol, FE_vol[-1])
             
         if plot:
+            import matplotlib.pyplot as plt
             plt.figure(figsize=(16,4), dpi= 100, facecolor='w', edgecolor='k')
             plt.suptitle(self.patientID,fontsize=12, fontweight='bold')
                 
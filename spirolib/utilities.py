@@ -4,7 +4,6 @@ Utility functions for spirometry data processing.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 class utilities:           
     def __init__(self):
@@ -47,6 +46,286 @@ class utilities:
              flow_comp=np.interp(time_comp,time,flow)
          return time_comp, vol_comp, flow_comp
     
+    # Stack a ragged list of 1D signals into a padded 2D array
+    def pad_signals(self,signals,lengths=None,fill_value=np.nan):
+        '''
+        Requires:
+        1. signals: list of 1D arrays, or a 2D array already padded
+        2. lengths: valid length of each row (only for a padded 2D array,
+           defaults to the full width)
+        Returns padded (B, N) float array and lengths
+        '''
+        if isinstance(signals,np.ndarray) and signals.ndim==2:
+            if lengths is None:
+                lengths=np.full(signals.shape[0],signals.shape[1])
+            return signals.astype(float,copy=False), np.asarray(lengths,dtype=int)
+        lengths=np.array([len(x) for x in signals],dtype=int)
+        padded=np.full((len(signals),lengths.max()),fill_value,dtype=float)
+        for i,x in enumerate(signals):
+            padded[i,:lengths[i]]=x
+        return padded, lengths
+    
+    # Batch versions of the FE start/end searches of spiro_signal_process
+    # Each row is treated as an FE signal (flag_given_signal_is_FE=True)
+    def backExtrapolate_FEstart_batch(self,time,volume,flow,lengths=None):
+        '''
+        Same as spiro_signal_process.backExtrapolate_FEstart for every curve
+        Requires:
+        1. time, volume, flow: ragged lists of 1D arrays or padded 2D arrays
+        2. lengths: valid length of each row of padded arrays
+        Returns arrays of FE start indexes and BEV criteria flags
+        '''
+        time,lengths=self.pad_signals(time,lengths)
+        volume,_=self.pad_signals(volume,lengths)
+        flow,_=self.pad_signals(flow,lengths)
+        rows=np.arange(len(lengths))
+        valid=np.arange(time.shape[1])<lengths[:,None]
+        time=time-time[:,:1]
+        vol=volume-volume[:,:1]
+        
+        PEF_Index=np.argmax(np.where(valid,flow,-np.inf),axis=1)
+        t_ep=time[rows,PEF_Index]-vol[rows,PEF_Index]/flow[rows,PEF_Index]
+        extrapolate=t_ep>=0
+        
+        in_interval=(time[:,:-1]<=t_ep[:,None]) & (t_ep[:,None]<time[:,1:]) & valid[:,1:]
+        found=in_interval.any(axis=1)
+        if np.any(extrapolate & ~found):
+            raise Exception('Back extrapolated start time lies beyond the end of the FE signal for curves '
+                            + str(np.flatnonzero(extrapolate & ~found)))
+        new_index1=np.where(extrapolate,np.argmax(in_interval,axis=1),0)
+        
+        FVC=np.abs(vol[rows,lengths-1]-vol[:,0])
+        BEV=vol[rows,new_index1]
+        thresh_vol=np.maximum(0.05*FVC,0.15)
+        BEV_criteria=np.where(extrapolate,BEV<=thresh_vol,True)
+        return new_index1, BEV_criteria
+    
+    def threshPEF_FEstart_batch(self,flow,thresh_percent_begin,lengths=None):
+        '''
+        Same as spiro_signal_process.threshPEF_FEstart for every curve
+        Requires:
+        1. flow: ragged list of 1D arrays or padded 2D array
+        2. thresh_percent_begin: threshold in percent of PEF
+        3. lengths: valid length of each row of a padded array
+        Returns array of FE start indexes
+        '''
+        flow,lengths=self.pad_signals(flow,lengths)
+        rows=np.arange(len(lengths))
+        cols=np.arange(flow.shape[1])
+        PEF_Index=np.argmax(np.where(cols<lengths[:,None],flow,-np.inf),axis=1)
+        threshold=(thresh_percent_begin/100)*flow[rows,PEF_Index]
+        
+        below=(flow<=threshold[:,None]) & (cols>=1) & (cols<=PEF_Index[:,None])
+        last=flow.shape[1]-1-np.argmax(below[:,::-1],axis=1)
+        temp_index1=np.where(below.any(axis=1),last,0)
+        return temp_index1+1
+    
+    def trim_FE_end_batch(self,flow,thresh_percent_end,lengths=None):
+        '''
+        Same as spiro_signal_process.trim_FE_end for every curve
+        Requires:
+        1. flow: ragged list of 1D arrays or padded 2D array
+        2. thresh_percent_end: threshold in percent of PEF
+        3. lengths: valid length of each row of a padded array
+        Returns array of FE end indexes
+        '''
+        flow,lengths=self.pad_signals(flow,lengths)
+        rows=np.arange(len(lengths))
+        cols=np.arange(flow.shape[1])
+        valid=cols<lengths[:,None]
+        PEF_Index=np.argmax(np.where(valid,flow,-np.inf),axis=1)
+        threshold=(thresh_percent_end/100)*flow[rows,PEF_Index]
+        
+        above=(flow>threshold[:,None]) & (cols>=1) & valid
+        last=flow.shape[1]-1-np.argmax(above[:,::-1],axis=1)
+        return np.where(above.any(axis=1),last,0)
+    
+    # Cost of the deflating balloon model after PEF for a population of (wn, zeta) candidates
+    def calc_balloon_cost(self,params,tau,vol,flow,x_t1,xdot_t1,work=None):
+        '''
+        Scores S candidates in one broadcast over the time samples
+        Requires:
+        1. params: (2, S) array of wn and zeta values (or a single pair)
+        2. tau: time since t1 (the PEF), 1D array of length n
+        3. vol, flow: oriented volume and flow after t1 (1D arrays of length n)
+        4. x_t1, xdot_t1: initial conditions (volume and flow at t1)
+        5. work: optional preallocated workspace of shape (4, >=S, n)
+        Returns the cost J of each candidate (1D array of length S)
+        '''
+        params=np.asarray(params,dtype=float)
+        wn=np.atleast_1d(params[0])
+        zeta=np.atleast_1d(params[1])
+        S=len(wn)
+        n=len(tau)
+        if work is None or work.shape[1]<S or work.shape[2]!=n:
+            work=np.empty((4,S,n))
+        e1,e2,r,tmp=work[0,:S],work[1,:S],work[2,:S],work[3,:S]
+
+        with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+            # Calculate dynamic components
+            sq=np.sqrt(zeta**2-1)
+            s1=(-zeta+sq)*wn # Pole 2
+            s2=(-zeta-sq)*wn # Pole 1
+            s3=(zeta+sq)*wn
+            s4=(zeta-sq)*wn
+            s5=2*wn*sq
+            C1=(x_t1*s3+xdot_t1)/s5
+            C2=(-x_t1*s4-xdot_t1)/s5
+
+            np.multiply(s1[:,None],tau,out=e1)
+            np.exp(e1,out=e1)
+            np.multiply(s2[:,None],tau,out=e2)
+            np.exp(e2,out=e2)
+
+            # volume residual
+            np.multiply(e1,C1[:,None],out=r)
+            np.multiply(e2,C2[:,None],out=tmp)
+            r+=tmp
+            r-=vol
+            J=np.einsum('ij,ij->i',r,r)
+
+            # flow residual
+            np.multiply(e1,(s1*C1)[:,None],out=r)
+            np.multiply(e2,(s2*C2)[:,None],out=tmp)
+            r+=tmp
+            r-=flow
+            J+=np.einsum('ij,ij->i',r,r)
+
+        J[~np.isfinite(J)]=np.inf
+        return J
+
+    # Deflating balloon response after PEF and its analytic derivatives in wn and zeta
+    def calc_balloon_jacobian(self,tau,x_t1,xdot_t1,wn,zeta):
+        '''
+        Returns h, h_dash (1D arrays) and their derivatives dh, dh_dash as (n, 2) arrays
+        with columns d/dwn and d/dzeta. Requires zeta>1 and wn>0
+        Inputs broadcast, e.g. tau of shape (M, n) with wn, zeta, x_t1, xdot_t1 of shape (M, 1)
+        give (M, n) and (M, n, 2) outputs
+        '''
+        sq=np.sqrt(zeta**2-1)
+        s1=(-zeta+sq)*wn
+        s2=(-zeta-sq)*wn
+        D=s1-s2
+        e1=np.exp(s1*tau)
+        e2=np.exp(s2*tau)
+        A=xdot_t1-s2*x_t1
+        B=s1*x_t1-xdot_t1
+        h=(A*e1+B*e2)/D
+        h_dash=(A*s1*e1+B*s2*e2)/D
+
+        # derivatives with respect to the poles
+        dh_ds1=(A*tau*e1+x_t1*e2-h)/D
+        dh_ds2=(-x_t1*e1+B*tau*e2+h)/D
+        dhd_ds1=(A*(1+s1*tau)*e1+x_t1*s2*e2-h_dash)/D
+        dhd_ds2=(-x_t1*s1*e1+B*(1+s2*tau)*e2+h_dash)/D
+
+        # chain rule to wn and zeta
+        ds1=np.stack([-zeta+sq+0*wn,wn*(-1+zeta/sq)],axis=-1)
+        ds2=np.stack([-zeta-sq+0*wn,wn*(-1-zeta/sq)],axis=-1)
+        dh=dh_ds1[...,None]*ds1+dh_ds2[...,None]*ds2
+        dh_dash=dhd_ds1[...,None]*ds1+dhd_ds2[...,None]*ds2
+        return h,h_dash,dh,dh_dash
+
+    # Fit the deflating balloon model after PEF with trust-region least squares
+    def fit_balloon_lsq(self,tau,vol,flow,x_t1,xdot_t1,bounds=[(0,3),(1,6)],starts=None):
+        '''
+        Local least-squares fit with the analytic Jacobian, started from a few
+        deterministic points in the bounds (fractions 0.25 and 0.75 of each range)
+        Requires oriented volume and flow after PEF and time since PEF (tau)
+        Returns wn, zeta, the cost J (sum of squared volume and flow errors) and
+        the number of function evaluations. Raises an Exception when no start reaches a finite cost
+        '''
+        from scipy.optimize import least_squares
+
+        # zeta=1 and wn=0 are singular in the closed form solution
+        lb=np.array([max(bounds[0][0],1e-6),max(bounds[1][0],1+1e-6)])
+        ub=np.array([bounds[0][1],bounds[1][1]])
+        if starts is None:
+            starts=[lb+f*(ub-lb) for f in (np.array([0.25,0.25]),np.array([0.75,0.25]),
+                                           np.array([0.25,0.75]),np.array([0.75,0.75]))]
+
+        def residuals(params):
+            h,h_dash,_,_=self.calc_balloon_jacobian(tau,x_t1,xdot_t1,params[0],params[1])
+            return np.concatenate((h-vol,h_dash-flow))
+
+        def jacobian(params):
+            _,_,dh,dh_dash=self.calc_balloon_jacobian(tau,x_t1,xdot_t1,params[0],params[1])
+            return np.vstack((dh,dh_dash))
+
+        best=None
+        nfev=0
+        for x0 in starts:
+            x0=np.clip(np.asarray(x0,dtype=float),lb,ub)
+            with np.errstate(over='ignore',invalid='ignore'):
+                try:
+                    res=least_squares(residuals,x0,jac=jacobian,bounds=(lb,ub),method='trf')
+                except ValueError: # residuals not finite at the start
+                    continue
+            nfev+=res.nfev
+            if np.isfinite(res.cost) and (best is None or res.cost<best.cost):
+                best=res
+        if best is None:
+            raise Exception('Least squares fit failed: the cost is not finite from any start (NaN or degenerate signal?)')
+        return best.x[0], best.x[1], 2*best.cost, nfev
+
+    # Closed-form estimate of the deflating balloon parameters after PEF
+    def fit_balloon_analytic(self,tau,vol,flow,x_t1,xdot_t1,bounds=[(0,3),(1,6)],refine=False):
+        '''
+        Linear least-squares estimate of wn and zeta from the integral form of the model
+        x'' + a x' + b x = 0 with a=2*zeta*wn and b=wn**2. Integrating once and twice gives
+            flow - xdot_t1 = -a (vol - x_t1) - b int(vol)
+            vol - x_t1 - xdot_t1 tau = -a (int(vol) - x_t1 tau) - b int(int(vol))
+        which are solved together for (a, b) in one 2-column solve, no derivatives of the
+        measured signal are needed. The estimate is clipped into the bounds (zeta>1)
+        It is an estimator, not a minimizer of the cost: on measured signals its cost ends well above
+        the differential evolution fit (15-70% in our tests). Use refine=True (the "analytic_lsq" solver
+        of run_model) when the fitted parameters are reported
+        Requires oriented volume and flow after PEF and time since PEF (tau)
+        With refine=True the estimate is polished by fit_balloon_lsq started from it
+        Returns wn, zeta, the cost J and the number of function evaluations
+        '''
+        tau=np.asarray(tau,dtype=float)
+        vol=np.asarray(vol,dtype=float)
+        flow=np.asarray(flow,dtype=float)
+
+        # cumulative trapezoidal integrals of volume
+        dt=np.diff(tau)
+        int_vol=np.concatenate(([0],np.cumsum(dt*(vol[1:]+vol[:-1])/2)))
+        int2_vol=np.concatenate(([0],np.cumsum(dt*(int_vol[1:]+int_vol[:-1])/2)))
+
+        A=np.vstack((np.column_stack((vol-x_t1,int_vol)),
+                     np.column_stack((int_vol-x_t1*tau,int2_vol))))
+        y=-np.concatenate((flow-xdot_t1,vol-x_t1-xdot_t1*tau))
+        (a,b),_,_,_=np.linalg.lstsq(A,y,rcond=None)
+
+        # zeta=1 and wn=0 are singular in the closed form solution
+        lb=np.array([max(bounds[0][0],1e-6),max(bounds[1][0],1+1e-6)])
+        ub=np.array([bounds[0][1],bounds[1][1]])
+        wn=np.sqrt(b) if b>0 else lb[0]
+        zeta=a/(2*wn) if a>0 else lb[1]
+        wn,zeta=np.clip([wn,zeta],lb,ub)
+
+        if refine:
+            return self.fit_balloon_lsq(tau,vol,flow,x_t1,xdot_t1,bounds=bounds,starts=[[wn,zeta]])
+        J=self.calc_balloon_cost([wn,zeta],tau,vol,flow,x_t1,xdot_t1)[0]
+        return wn, zeta, J, 1
+
+    # Mean squared error between a signal and its model
+    def calc_mse(self,y_true,y_pred):
+        y_true=np.asarray(y_true,dtype=float)
+        y_pred=np.asarray(y_pred,dtype=float)
+        return np.mean((y_true-y_pred)**2)
+
+    # Coefficient of determination (R2) of a model, 1 for a perfect fit of a constant signal
+    def calc_r2_score(self,y_true,y_pred):
+        y_true=np.asarray(y_true,dtype=float)
+        y_pred=np.asarray(y_pred,dtype=float)
+        ss_res=np.sum((y_true-y_pred)**2)
+        ss_tot=np.sum((y_true-np.mean(y_true))**2)
+        if ss_tot==0:
+            return 1.0 if ss_res==0 else 0.0
+        return 1-ss_res/ss_tot
+
     def add_noise_to_FVLdata(self,sp,mode):
         time = sp.time
         flow = sp.flow
@@ -54,6 +333,8 @@ class utilities:
         
         index1, index2 = sp.get_FE_start_end(start_type="thresh_PEF")
         index1s = sp.get_Indexes_In_1s(start_index = index1)
+        if index1s<0:
+            raise Exception('FE signal is shorter than 1 s, noise cannot be added')
         
         PEF_index = sp.get_PEF_index(index1, index2)
         PEF = flow[PEF_index]
@@ -74,46 +355,134 @@ class utilities:
           flow[begin_indx:begin_indx+n_locs]=np.random.normal(0,1,n_locs)* max_flow_noise
           
         
+        sp.clear_FE_cache() # flow was modified in place
         vol_noise = self.get_vol_from_flow(flow,time)
         return vol_noise, flow
         
         
     
+    # Layout of the plot area in the figure rendered by convert2grayscale, in figure fractions
+    # (matplotlib default subplot parameters, the box shrinks to a fixed aspect in FVL mode)
+    def get_plot_area(self, x_min, x_max, y_min, y_max, mode='FVL', x_unit_spacing=10, y_unit_spacing=10):
+        '''
+        Inputs are arrays (one value per curve) of the data ranges
+        Returns left, bottom, width, height of the plot area and the axis limits x_lo, x_len, y_lo, y_len
+        '''
+        left, bottom, width, height = 0.125, 0.11, 0.775, 0.77
+        x_lo=x_min-0.5
+        x_len=x_max-x_min+1
+        y_lo=y_min-0.5
+        y_len=y_max-y_min+1
+        left=np.full(np.shape(x_min), left)
+        bottom=np.full(np.shape(x_min), bottom)
+        width=np.full(np.shape(x_min), width)
+        height=np.full(np.shape(x_min), height)
+        if mode=='FVL':
+            # one flow unit is displayed half as long as one volume unit
+            fig_w=(x_max-x_min+2)*x_unit_spacing
+            fig_h=(y_max-y_min+2)*y_unit_spacing
+            ratio=0.5*y_len/x_len
+            box_w=np.minimum(width*fig_w, height*fig_h/ratio)
+            box_h=ratio*box_w
+            left=left+(width-box_w/fig_w)/2
+            bottom=bottom+(height-box_h/fig_h)/2
+            width=box_w/fig_w
+            height=box_h/fig_h
+        return left, bottom, width, height, x_lo, x_len, y_lo, y_len
+
+    # Anti-aliased rendering of many curves into grayscale images, without matplotlib
+    def rasterize_curves(self, curves, mode='FVL', size=32, x_unit_spacing=10, y_unit_spacing=10, line_width=1.0,
+                         dtype='uint8', out=None, chunk=1024):
+        '''
+        Renders each curve as a dark line on a white background, laid out as in convert2grayscale
+        Requires:
+        1. curves: list of (x, y) pairs, (volume, flow) in 'FVL' mode or (time, volume) in 'VT' mode
+        2. size: width and height of the images in pixels
+        3. line_width: width of the line in pixels
+        4. dtype: 'uint8' (0 to 255) or 'float32' (0 to 1)
+        5. out: optional (N, size, size) array to fill, or path of a .npy file which is created
+           memory-mapped (e.g. for large training sets)
+        6. chunk: number of curves rendered at once
+        Returns the (N, size, size) array of images, blank (white) for curves with less than two samples
+        The polyline is sampled every quarter of a pixel and each sample is splatted bilinearly,
+        which gives the coverage of a line of one pixel width
+        '''
+        dtype=np.dtype(dtype)
+        N=len(curves)
+        if out is None:
+            out=np.empty((N,size,size),dtype=dtype)
+        elif isinstance(out,str):
+            out=np.lib.format.open_memmap(out,mode='w+',dtype=dtype,shape=(N,size,size))
+        step=0.25
+
+        for c0 in range(0,N,chunk):
+            batch=curves[c0:c0+chunk]
+            B=len(batch)
+            lengths=np.array([len(c[0]) for c in batch],dtype=int)
+            for i,c in enumerate(batch):
+                if len(c[1])!=lengths[i]:
+                    raise Exception('Length of x and y of curve '+str(c0+i)+' do not match')
+            starts=np.concatenate(([0],np.cumsum(lengths)[:-1]))
+            x=np.concatenate([np.asarray(c[0],dtype=float) for c in batch])
+            y=np.concatenate([np.asarray(c[1],dtype=float) for c in batch])
+            curve=np.repeat(np.arange(B),lengths)
+
+            # data ranges per curve, reduceat needs the starts of non-empty curves only
+            ranges=np.zeros((4,B))
+            nonempty=lengths>0
+            if np.any(nonempty):
+                first=starts[nonempty]
+                ranges[:,nonempty]=(np.minimum.reduceat(x,first),np.maximum.reduceat(x,first),
+                                    np.minimum.reduceat(y,first),np.maximum.reduceat(y,first))
+
+            # map the data to pixel coordinates (row 0 at the top)
+            left,bottom,width,height,x_lo,x_len,y_lo,y_len=self.get_plot_area(*ranges,mode,x_unit_spacing,y_unit_spacing)
+            px=size*(left[curve]+width[curve]*(x-x_lo[curve])/x_len[curve])
+            py=size*(1-bottom[curve]-height[curve]*(y-y_lo[curve])/y_len[curve])
+
+            # samples along every segment, each standing for seg_len/k of line length
+            seg=np.flatnonzero(curve[1:]==curve[:-1])
+            dx=px[seg+1]-px[seg]
+            dy=py[seg+1]-py[seg]
+            seg_len=np.hypot(dx,dy)
+            k=np.maximum(np.ceil(seg_len/step).astype(int),1)
+            rep=np.repeat(np.arange(len(seg)),k)
+            frac=(np.arange(len(rep))-np.repeat(np.cumsum(k)-k,k)+0.5)/k[rep]
+            sx=px[seg][rep]+frac*dx[rep]-0.5
+            sy=py[seg][rep]+frac*dy[rep]-0.5
+            w=(seg_len/k)[rep]
+            c=curve[seg][rep]
+
+            # bilinear splat into the four neighbouring pixels
+            ix=np.floor(sx).astype(int)
+            iy=np.floor(sy).astype(int)
+            fx=sx-ix
+            fy=sy-iy
+            coverage=np.zeros(B*size*size)
+            for ox,oy,wk in ((0,0,(1-fx)*(1-fy)),(1,0,fx*(1-fy)),(0,1,(1-fx)*fy),(1,1,fx*fy)):
+                cx=ix+ox
+                cy=iy+oy
+                inside=(cx>=0)&(cx<size)&(cy>=0)&(cy<size)
+                coverage+=np.bincount((c*size+cy)[inside]*size+cx[inside],weights=(w*wk)[inside],minlength=B*size*size)
+            image=1-np.clip(line_width*coverage,0,1).reshape(B,size,size)
+            if dtype==np.uint8:
+                out[c0:c0+B]=np.rint(255*image)
+            else:
+                out[c0:c0+B]=image
+        return out
+
     def convert2grayscale(self, x,y, mode='FVL',size=32, fig_dpi = 150, monitor_dpi = 145, x_unit_spacing =10, y_unit_spacing=10 , axis_flag ='on',plot_original=False,display_GS=False):
-        from skimage import color
-        from scipy.misc import imresize 
-        
-        f, ax = plt.subplots(frameon=False)
-        y_range = abs(np.max(y) - np.min(y))  +  2
-        x_range = abs(np.max(x) - np.min(y))  + 2
-        disp_inches_height = (monitor_dpi/fig_dpi)*y_range * y_unit_spacing * 0.039
-        disp_inches_width = (monitor_dpi/fig_dpi)*x_range * x_unit_spacing * 0.039
-        f.set_size_inches(disp_inches_width ,disp_inches_height)
-        f.set_dpi(fig_dpi)
-        ax.axis(axis_flag)
-        ax.plot(x,y, color='black')
-        
-        if mode =='FVL': # for flow-volume loop
-            # x : volume, y : flow
-            # x_unit-spacing will be adjusted according to aspect ratio
-            ax.set_aspect(0.5)
-        elif mode == 'VT': # for vol-time renderin
-            pass
-            # x : time, y : volume
-            
-        ax.set_xlim([np.min(x)-0.5, np.max(x)+0.5])
-        ax.set_ylim([np.min(y)-0.5, np.max(y)+0.5])
-         
-        f.canvas.draw()
-            
-        # grab the pixel buffer and dump it into a numpy array
-        X_img_orig = np.array(f.canvas.renderer._renderer)
-        if plot_original==False:
-             f.clear()
-         
-        X_gray = color.rgb2gray(X_img_orig)
-        X_gray_resized = imresize(X_gray, (size,size),  interp='bicubic')
-         
+        # Grayscale (size x size, uint8) image of a flow-volume loop ('FVL', x: volume, y: flow) or
+        # volume-time curve ('VT', x: time, y: volume), rendered with rasterize_curves
+        # fig_dpi, monitor_dpi and axis_flag are kept for compatibility, axes are not drawn
+        X_gray_resized = self.rasterize_curves([(x,y)], mode=mode, size=size, x_unit_spacing=x_unit_spacing,
+                                               y_unit_spacing=y_unit_spacing)[0]
+        
+        if plot_original or display_GS:
+            import matplotlib.pyplot as plt
+        if plot_original:
+            plt.figure()
+            plt.plot(x,y, color='black')
         if display_GS:
             fig2 = plt.figure()
             ax2 = fig2.add_subplot(111, frameon=False)
@@ -124,6 +493,7 @@ class utilities:
         return X_gray_resized
 
     def plot_Model(self,PLotdictslist, title_str):
+        import matplotlib.pyplot as plt
         
         total_plots=len(PLotdictslist)
         
@@ -166,4 +536,353 @@ class utilities:
                 plt.grid(True,which='both')
                 plt.xlabel(xlabel)
                 plt.ylabel(ylabel)
-                plt.legend()
\ No newline at end of file
+                plt.legend()
+
+class result_cache:
+    # Disk cache for expensive model fits, shared safely by several processes
+    # Entries are keyed on a hash of the input arrays, the settings and the library version,
+    # written atomically (os.replace) and evicted least recently used first when the
+    # directory grows beyond max_bytes
+    def __init__(self, path, max_bytes=2**30):
+        self.path=path
+        self.max_bytes=max_bytes
+        self._size=None # estimate of the directory size, rescanned when it exceeds max_bytes
+
+    def get_key(self, name, arrays, settings):
+        '''
+        Requires:
+        1. name: name of the computation (e.g. 'deflating_baloon.run_model')
+        2. arrays: list of input arrays
+        3. settings: dictionary of settings that change the result
+        Returns the hex digest used as key
+        '''
+        import hashlib
+        from . import __version__
+        h=hashlib.sha256()
+        h.update((name+'|'+__version__+'|'+repr(sorted(settings.items()))).encode())
+        for a in arrays:
+            a=np.ascontiguousarray(a)
+            h.update((str(a.dtype)+str(a.shape)).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def get_file(self, key):
+        import os
+        return os.path.join(self.path, key[:2], key+'.pkl')
+
+    def get(self, key):
+        # Cached value or None
+        import os
+        import pickle
+        file=self.get_file(key)
+        try:
+            with open(file, 'rb') as f:
+                value=pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(file) # mark as recently used
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        import os
+        import pickle
+        import tempfile
+        file=self.get_file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        fd, tmp=tempfile.mkstemp(dir=os.path.dirname(file), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, file)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self._size is None:
+            self._size=sum(size for _, size, _ in self.scan())
+        else:
+            self._size+=os.path.getsize(file)
+        if self._size>self.max_bytes:
+            self.evict()
+
+    def scan(self):
+        # (file, size, last use) of all entries
+        import os
+        entries=[]
+        if not os.path.isdir(self.path):
+            return entries
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.pkl'):
+                    try:
+                        stat=entry.stat()
+                    except OSError: # removed by another process
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        # Removes least recently used entries until the cache is below 90% of max_bytes
+        import os
+        entries=sorted(self.scan(), key=lambda e: e[2])
+        size=sum(e[1] for e in entries)
+        for file, file_size, _ in entries:
+            if size<=0.9*self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            size-=file_size
+        self._size=size
+
+    def clear(self):
+        import os
+        for file, _, _ in self.scan():
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+        self._size=0
+
+class balloon_lut:
+    # Precomputed deflating balloon responses on a (wn, zeta) grid for a nearest-fit search
+    # The response after PEF is linear in the initial conditions, h = x_t1*g1 + xdot_t1*g2, so
+    # the table stores the unit responses g1, g2 and their derivatives once per grid point on a
+    # uniform time grid. Scoring a signal against every grid point is then a single broadcast.
+    # With a path the table is saved as .npy (atomically) and memory-mapped, so worker
+    # processes share one copy through the page cache
+    _tables={} # tables loaded in this process, by file or settings
+    _defaults={} # tables used by the fits when no lut is passed, by bounds and t_max
+
+    def __init__(self, path=None, wn_range=(0,3), zeta_range=(1,6), n_wn=100, n_zeta=100, dt=0.05, t_max=20,
+                 dtype='float32'):
+        self.path=path
+        self.settings={'wn_range':tuple(wn_range), 'zeta_range':tuple(zeta_range), 'n_wn':n_wn,
+                       'n_zeta':n_zeta, 'dt':dt, 't_max':t_max, 'dtype':str(np.dtype(dtype))}
+        # cell centres, so the singular wn=0 and zeta=1 are never on the grid
+        wn=wn_range[0]+(np.arange(n_wn)+0.5)*(wn_range[1]-wn_range[0])/n_wn
+        zeta=zeta_range[0]+(np.arange(n_zeta)+0.5)*(zeta_range[1]-zeta_range[0])/n_zeta
+        wn, zeta=np.meshgrid(wn, zeta, indexing='ij')
+        self.wn=wn.ravel()
+        self.zeta=zeta.ravel()
+        self.tau=np.arange(int(round(t_max/dt))+1)*dt
+        self.table=None
+
+    @classmethod
+    def get_default(cls, wn_range, zeta_range, t_end=0):
+        # Table over the given bounds shared by all fits of this process that cover at most
+        # t_end seconds after PEF (t_max is rounded up to a multiple of 20 s)
+        t_max=20*max(1, int(np.ceil(t_end/20)))
+        key=(tuple(wn_range), tuple(zeta_range), t_max)
+        if key not in cls._defaults:
+            cls._defaults[key]=cls(wn_range=wn_range, zeta_range=zeta_range, t_max=t_max)
+        return cls._defaults[key]
+
+    def __getstate__(self):
+        # the table is reloaded (memory-mapped) by the receiving process
+        state=dict(self.__dict__)
+        state['table']=None
+        return state
+
+    def get_file(self):
+        import os
+        import hashlib
+        key=hashlib.sha256(repr(sorted(self.settings.items())).encode()).hexdigest()[:16]
+        return os.path.join(self.path, 'balloon_lut_'+key+'.npy')
+
+    def build(self):
+        '''
+        Returns the (4, K, m) table of g1, g2, g1_dash and g2_dash for the K grid points
+        and the m time samples of tau
+        '''
+        sq=np.sqrt(self.zeta**2-1)
+        s1=((-self.zeta+sq)*self.wn)[:,None]
+        s2=((-self.zeta-sq)*self.wn)[:,None]
+        D=s1-s2
+        table=np.empty((4, len(self.wn), len(self.tau)), dtype=self.settings['dtype'])
+        e1=np.exp(s1*self.tau)
+        e2=np.exp(s2*self.tau)
+        table[0]=(s1*e2-s2*e1)/D # x_t1=1, xdot_t1=0
+        table[1]=(e1-e2)/D # x_t1=0, xdot_t1=1
+        table[2]=s1*s2*(e2-e1)/D
+        table[3]=(s1*e1-s2*e2)/D
+        return table
+
+    def load(self, mmap_mode='r'):
+        # Builds the table once (and saves it when a path is given), later calls reuse it
+        import os
+        import tempfile
+        if self.table is not None:
+            return self.table
+        name=self.get_file() if self.path is not None else repr(sorted(self.settings.items()))
+        if name in balloon_lut._tables:
+            self.table=balloon_lut._tables[name]
+            return self.table
+        if self.path is None:
+            table=self.build()
+        else:
+            if not os.path.exists(name):
+                os.makedirs(self.path, exist_ok=True)
+                fd, tmp=tempfile.mkstemp(dir=self.path, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.save(f, self.build())
+                    os.replace(tmp, name)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            table=np.load(name, mmap_mode=mmap_mode)
+        balloon_lut._tables[name]=table
+        self.table=table
+        return table
+
+    def calc_costs(self, tau, vol, flow, x_t1, xdot_t1, max_elements=2**22):
+        '''
+        Cost of every grid point for one signal, on the signal resampled to the table time grid
+        Requires oriented volume and flow after PEF and time since PEF (tau)
+        Returns a 1D array of length K
+        Raises an Exception when the signal is longer than t_max
+        '''
+        dt=self.settings['dt']
+        if tau[-1]>=self.tau[-1]+dt:
+            raise Exception('Signal lasts '+str(round(float(tau[-1]),2))+' s after PEF, longer than t_max='
+                            +str(self.settings['t_max'])+' s of the lookup table')
+        table=self.load()
+        m=min(np.searchsorted(self.tau, tau[-1], side='right'), len(self.tau))
+        # computed in the table precision
+        vol_r=np.interp(self.tau[:m], tau, vol).astype(table.dtype)
+        flow_r=np.interp(self.tau[:m], tau, flow).astype(table.dtype)
+        x_t1, xdot_t1=table.dtype.type(x_t1), table.dtype.type(xdot_t1)
+        K=len(self.wn)
+        J=np.empty(K)
+        step=max(1, max_elements//max(m, 1))
+        for i in range(0, K, step):
+            g=table[:, i:i+step, :m]
+            r=x_t1*g[0]+xdot_t1*g[1]-vol_r
+            J[i:i+step]=np.einsum('ij,ij->i', r, r)
+            r=x_t1*g[2]+xdot_t1*g[3]-flow_r
+            J[i:i+step]+=np.einsum('ij,ij->i', r, r)
+        return J
+
+    def fit(self, tau, vol, flow, x_t1, xdot_t1, refine=False):
+        '''
+        Nearest fit in the table, optionally polished by utilities.fit_balloon_lsq
+        Returns wn, zeta, the cost J on the given samples and the number of function evaluations
+        '''
+        ut=utilities()
+        i=np.argmin(self.calc_costs(tau, vol, flow, x_t1, xdot_t1))
+        wn, zeta=self.wn[i], self.zeta[i]
+        if refine:
+            return ut.fit_balloon_lsq(tau, vol, flow, x_t1, xdot_t1,
+                                      bounds=[self.settings['wn_range'], self.settings['zeta_range']],
+                                      starts=[[wn, zeta]])
+        J=ut.calc_balloon_cost([wn, zeta], tau, vol, flow, x_t1, xdot_t1)[0]
+        return wn, zeta, J, 1
+
+class fit_budget:
+    # Time and evaluation budget shared by successive differential_evolution calls of one fit
+    # Pass callback (get_callback(population) for a vectorized call) to differential_evolution,
+    # which then stops with the best solution found so far once budget_ms has elapsed since
+    # construction or max_nfev cost evaluations have been used. Evaluations are counted per
+    # candidate on every path: a vectorized call scores the whole population per call of the
+    # cost function, which differential_evolution counts as one
+    def __init__(self, budget_ms=None, max_nfev=None):
+        import time
+        self.deadline=None if budget_ms is None else time.perf_counter()+budget_ms/1000
+        self.max_nfev=max_nfev
+        self.nfev=0 # cost evaluations of finished calls
+        self.stopped=False
+        self.converged=True # all finished calls converged
+
+    @staticmethod
+    def get_population(popsize, n_params):
+        # number of candidates differential_evolution scores per generation
+        return max(5, popsize*max(1, n_params))
+
+    @staticmethod
+    def get_nfev(res, population=1):
+        # cost evaluations of a finished differential_evolution call. With population>1 (vectorized)
+        # res.nfev counts one per generation (plus the initial population) and one per polish step
+        if population==1:
+            return res.nfev
+        generations=res.nit+1
+        return generations*population+max(res.nfev-generations, 0)
+
+    def is_active(self):
+        return self.deadline is not None or self.max_nfev is not None
+
+    def is_exhausted(self, nfev=0):
+        import time
+        return ((self.deadline is not None and time.perf_counter()>=self.deadline) or
+                (self.max_nfev is not None and self.nfev+nfev>=self.max_nfev))
+
+    def callback(self, intermediate_result):
+        # for calls that score one candidate per call of the cost function
+        if self.is_exhausted(intermediate_result.nfev):
+            self.stopped=True
+            return True
+        return False
+
+    def get_callback(self, population=1):
+        # callback for a call that scores population candidates per call of the cost function
+        def callback(intermediate_result):
+            if self.is_exhausted(intermediate_result.nfev*population):
+                self.stopped=True
+                return True
+            return False
+        return callback
+
+    def add_result(self, res, population=1):
+        # Accounts for a finished call, returns its number of cost evaluations
+        nfev=self.get_nfev(res, population)
+        self.nfev+=nfev
+        self.converged=self.converged and bool(res.success)
+        return nfev
+
+class fit_history:
+    # Latest deflating balloon fit (wn, zeta) of each patient, used as prior for the next fit of the
+    # same patient (follow-up visits, pre/post bronchodilator). With a path the history is loaded
+    # from and saved to a pickle file, written atomically (the last writer wins)
+    def __init__(self, path=None):
+        import os
+        import pickle
+        self.path=path
+        self.fits={}
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.fits=pickle.load(f)
+
+    def __len__(self):
+        return len(self.fits)
+
+    def get(self, patientID):
+        # (wn, zeta) of the last fit of the patient or None
+        return self.fits.get(patientID)
+
+    def add(self, patientID, wn, zeta):
+        self.fits[patientID]=(float(wn), float(zeta))
+
+    def save(self):
+        import os
+        import pickle
+        import tempfile
+        if self.path is None:
+            raise Exception('fit_history has no path to save to')
+        folder=os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp=tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self.fits, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic spirometry signals used by the tests
+"""
+
+import numpy as np
+
+
+def balloon_FE(fs=100, wn=1.1, zeta=2.2, PEF=8.0, t_PEF=0.12, FVC=4.5, duration=8.0, noise=0.0, seed=0):
+    # FE time, volume and flow: linear rise to PEF, then the deflating balloon response
+    rng=np.random.default_rng(seed)
+    time=np.arange(0,duration,1.0/fs)
+    flow=np.empty_like(time)
+    rise=time<t_PEF
+    flow[rise]=PEF*time[rise]/t_PEF
+    x1=FVC-0.5*PEF*t_PEF
+    tau=time[~rise]-t_PEF
+    s1=(-zeta+np.sqrt(zeta**2-1))*wn
+    s2=(-zeta-np.sqrt(zeta**2-1))*wn
+    C1=(-PEF-s2*x1)/(s1-s2)
+    C2=(s1*x1+PEF)/(s1-s2)
+    flow[~rise]=-(s1*C1*np.exp(s1*tau)+s2*C2*np.exp(s2*tau))
+    flow=flow+noise*rng.standard_normal(len(time))
+    volume=np.concatenate(([0],np.cumsum(np.diff(time)*flow[1:])))
+    return time, volume, flow
+
+
+def full_manoeuvre(fs=100, seed=0, **kwargs):
+    # tidal breathing, forced inspiration to TLC and a balloon FE (volume decreasing from RV to TLC)
+    FE_time, FE_volume, FE_flow=balloon_FE(fs=fs, seed=seed, **kwargs)
+    tidal_time=np.arange(int(6*fs))/fs
+    tidal_volume=2.5+0.3*np.sin(2*np.pi*tidal_time/3)
+    FI_volume=np.linspace(tidal_volume[-1],0,int(2*fs)+1)[1:]
+    volume=np.concatenate((tidal_volume,FI_volume,FE_volume[1:]))
+    time=np.arange(len(volume))/fs
+    flow=np.concatenate(([0],np.diff(volume)*fs))
+    return time, volume, flow
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Cached FE segmentation is dropped when the signals change
+"""
+
+import numpy as np
+
+from spirolib import spiro_signal_process, utilities
+from synthetic import full_manoeuvre
+
+
+def signal_process(time, volume, flow):
+    # copies, get_FE_start_end may modify the volume of a full manoeuvre
+    return spiro_signal_process(time.copy(), volume.copy(), flow.copy(), 'P0', 'T0', False)
+
+
+def test_new_volume_and_flow_invalidate_cache():
+    time, volume, flow=full_manoeuvre(noise=0.02)
+    sp=signal_process(time, volume, flow)
+    before=sp.get_FE_start_end(start_type="BEV")
+    # shorter expiration followed by a plateau, so that the FE end moves
+    _, new_volume, new_flow=full_manoeuvre(FVC=3.5, PEF=6.0, duration=6.0, noise=0.02, seed=1)
+    new_volume=np.concatenate((new_volume, np.full(len(volume)-len(new_volume), new_volume[-1])))
+    new_flow=np.concatenate((new_flow, np.zeros(len(flow)-len(new_flow))))
+    sp.volume=new_volume.copy()
+    sp.flow=new_flow.copy()
+    expected=signal_process(time, new_volume, new_flow)
+    assert sp.get_FE_start_end(start_type="BEV")==expected.get_FE_start_end(start_type="BEV")
+    assert sp.get_FE_start_end(start_type="BEV")!=before
+    for signal in [sp, expected]:
+        assert signal.check_acceptability_of_spirogram(min_FE_time=4)==(True, 'Accepted')
+        signal.finalize_signal()
+    for param in ['index1', 'index2', 'FEV1', 'FVC', 'PEF', 'FEF25', 'FEF50', 'FEF75']:
+        assert getattr(sp, param)==getattr(expected, param)
+
+
+def test_new_time_invalidates_time_index():
+    time, volume, flow=full_manoeuvre()
+    sp=signal_process(time, volume, flow)
+    assert sp.get_Indexes_In_1s()==100
+    sp.time=time*2
+    assert sp.get_Indexes_In_1s()==50
+
+
+def test_add_noise_invalidates_cache():
+    for mode in [1, 2]:
+        np.random.seed(mode)
+        sp=signal_process(*full_manoeuvre())
+        sp.get_FE_start_end(start_type="thresh_PEF")
+        utilities().add_noise_to_FVLdata(sp, mode)
+        expected=signal_process(sp.time, sp.volume, sp.flow)
+        assert sp.get_FE_start_end(start_type="thresh_PEF")==expected.get_FE_start_end(start_type="thresh_PEF")
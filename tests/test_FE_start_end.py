@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+FE start and end searches against the original sample by sample loops
+"""
+
+import numpy as np
+
+from spirolib import spiro_signal_process, utilities
+from synthetic import balloon_FE
+
+
+def backExtrapolate_FEstart_loop(time, vol, flow):
+    # original implementation of backExtrapolate_FEstart for an FE signal
+    vol=vol-vol[0]
+    time=time-time[0]
+    PEF_Index=np.argmax(flow)
+    t_ep=time[PEF_Index]-vol[PEF_Index]/flow[PEF_Index]
+    temp_index=0
+    if t_ep>=0:
+        while temp_index<len(time)-1:
+            if t_ep>=time[temp_index] and t_ep<time[temp_index+1]:
+                new_index1=temp_index
+                break
+            else:
+                temp_index=temp_index+1
+        FVC=abs(vol[-1]-vol[0])
+        BEV=vol[new_index1]
+        BEV_criteria=BEV<=np.maximum(0.05*FVC,0.15)
+    else:
+        new_index1=0
+        BEV_criteria=True
+    return new_index1, BEV_criteria
+
+
+def threshPEF_FEstart_loop(flow, thresh_percent_begin):
+    # original implementation of threshPEF_FEstart for an FE signal
+    PEF_Index=np.argmax(flow)
+    flow_excit=flow[0:PEF_Index+1]
+    threshold=(thresh_percent_begin/100)*flow[PEF_Index]
+    temp_index1=int(len(flow_excit)-1)
+    while flow_excit[temp_index1]>threshold and temp_index1>0:
+        temp_index1=temp_index1-1
+    return temp_index1+1
+
+
+def trim_FE_end_loop(flow, thresh_percent_end):
+    # original implementation of trim_FE_end for an FE signal
+    threshold=(thresh_percent_end/100)*flow[np.argmax(flow)]
+    temp_index2=len(flow)-1
+    while (temp_index2>0) and (flow[temp_index2]<=threshold):
+        temp_index2=temp_index2-1
+    return temp_index2
+
+
+def random_FE(rng):
+    time, volume, flow=balloon_FE(fs=rng.choice([10,50,100]), wn=rng.uniform(0.5,2), zeta=rng.uniform(1.2,4),
+                                  t_PEF=rng.uniform(0.05,0.4), noise=rng.choice([0,0.05,0.3]),
+                                  duration=rng.uniform(2,8), seed=rng.integers(1000))
+    # slow start, delayed by up to 0.3 s
+    n_delay=rng.integers(0,int(0.3/(time[1]-time[0]))+1)
+    time=np.concatenate((time,time[-1]+(time[1]-time[0])*np.arange(1,n_delay+1)))
+    volume=np.concatenate((np.zeros(n_delay),volume))+rng.uniform(0,0.2)*np.concatenate((np.linspace(0,1,n_delay),np.ones(len(volume))))
+    flow=np.concatenate((np.full(n_delay,0.01),flow))
+    return time, volume, flow
+
+
+def test_FE_start_end_match_loops():
+    rng=np.random.default_rng(0)
+    ut=utilities()
+    curves=[random_FE(rng) for _ in range(200)]
+    thresholds=[0.5, 2, 5, 10]
+    for time, volume, flow in curves:
+        sp=spiro_signal_process(time, volume, flow, 'P', 1, True)
+        index1, BEV_criteria=sp.backExtrapolate_FEstart()
+        assert (index1, bool(BEV_criteria))==backExtrapolate_FEstart_loop(time, volume, flow)
+        for thresh in thresholds:
+            assert sp.threshPEF_FEstart(thresh)==threshPEF_FEstart_loop(flow, thresh)
+            assert sp.trim_FE_end(thresh)==trim_FE_end_loop(flow, thresh)
+    
+    # batch versions
+    time, volume, flow=zip(*curves)
+    index1, BEV_criteria=ut.backExtrapolate_FEstart_batch(list(time), list(volume), list(flow))
+    expected=[backExtrapolate_FEstart_loop(*c) for c in curves]
+    assert index1.tolist()==[e[0] for e in expected]
+    assert BEV_criteria.tolist()==[bool(e[1]) for e in expected]
+    for thresh in thresholds:
+        assert ut.threshPEF_FEstart_batch(list(flow), thresh).tolist()==[threshPEF_FEstart_loop(f, thresh) for f in flow]
+        assert ut.trim_FE_end_batch(list(flow), thresh).tolist()==[trim_FE_end_loop(f, thresh) for f in flow]
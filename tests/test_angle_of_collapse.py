@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+The vectorized angle of collapse search against the original point by point loop
+"""
+
+import numpy as np
+
+from spirolib import spiro_features_extraction
+
+
+def min_line_model_error_loop(ac):
+    # original implementation of min_line_model_error
+    Jmin=1e10
+    x_hat=None
+    y_hat=None
+    ind_min=None
+    n=len(ac.volume)
+    for i in range(1,n-1):
+        x=ac.volume[i]
+        y=ac.flow[i]
+        _, line_model_flow = ac.generate_linemodel(x,y,i)
+        J=(np.sum((line_model_flow-ac.flow)**2))/n
+        if J<=Jmin:
+            Jmin=J
+            x_hat=x
+            y_hat=y
+            ind_min=i
+    return x_hat, y_hat, Jmin, ind_min
+
+
+def random_FE(rng, n, noise, decimals):
+    volume=np.linspace(0,4,n)+rng.normal(0,noise,n)
+    flow=6*np.exp(-np.linspace(0,4,n))*(1+0.3*rng.random())+rng.normal(0,0.05,n)
+    volume=np.concatenate(([volume[0]-0.01],volume))
+    flow=np.concatenate(([0.5],flow))
+    if decimals is not None:
+        # duplicate volume values
+        volume=np.round(volume,decimals)
+        flow=np.round(flow,decimals)
+    return volume, flow
+
+
+def test_min_line_model_error_matches_loop():
+    rng=np.random.default_rng(0)
+    for t in range(300):
+        volume, flow=random_FE(rng, rng.integers(5,120), [0,0.01,0.1][t%3], [None,1,2][(t//3)%3])
+        ac=spiro_features_extraction.angle_of_collapse(volume, flow)
+        assert ac.min_line_model_error()==min_line_model_error_loop(ac)
+
+
+def test_line_model_errors_matches_generate_linemodel():
+    rng=np.random.default_rng(1)
+    volume, flow=random_FE(rng, 400, 0.3, None)
+    ac=spiro_features_extraction.angle_of_collapse(volume, flow)
+    n=len(ac.volume)
+    expected=[np.sum((ac.generate_linemodel(ac.volume[i],ac.flow[i],i)[1]-ac.flow)**2)/n for i in range(1,n-1)]
+    np.testing.assert_allclose(ac.line_model_errors(), expected, rtol=0, atol=1e-10)
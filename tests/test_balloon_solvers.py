@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Solver selection and failure modes of the deflating balloon fits
+"""
+
+import numpy as np
+import pytest
+
+from spirolib import balloon_lut, spiro_features_lite, utilities
+from synthetic import balloon_FE
+
+
+def lite(**kwargs):
+    sl=spiro_features_lite()
+    sl.time_us, sl.volume_us, sl.flow_us=balloon_FE(fs=10, **kwargs)
+    return sl
+
+
+def test_lite_rejects_unknown_solver():
+    with pytest.raises(Exception, match='Unknown solver'):
+        lite().calc_def_balloon_lite(solver="bogus")
+
+
+def test_lite_lsq_matches_de():
+    fit_de=lite().calc_def_balloon_lite(solver="de", seed=0)
+    fit_lsq=lite().calc_def_balloon_lite(solver="lsq")
+    np.testing.assert_allclose(fit_lsq, fit_de, rtol=1e-3)
+
+
+def test_lsq_raises_when_no_start_is_finite():
+    tau=np.arange(50)*0.1
+    vol=np.full(50, np.nan)
+    with pytest.raises(Exception, match='Least squares fit failed'):
+        utilities().fit_balloon_lsq(tau, vol, vol, 1.0, -5.0)
+
+
+def test_lut_rejects_signals_longer_than_table():
+    time, volume, flow=balloon_FE(fs=10, duration=8)
+    lut=balloon_lut(n_wn=10, n_zeta=10, t_max=5)
+    with pytest.raises(Exception, match='longer than t_max'):
+        lut.fit(time, volume, flow, volume[0], flow[0])
+
+
+def test_lite_default_lut_is_shared_and_covers_signal():
+    sl=lite(duration=30)
+    sl.calc_def_balloon_lite(solver="lut")
+    default=balloon_lut.get_default((0,10), (1,10), 30)
+    assert default.settings['t_max']==40
+    table=default.table
+    assert table is not None
+    lite(duration=25).calc_def_balloon_lite(solver="lut")
+    assert balloon_lut.get_default((0,10), (1,10), 25).table is table
+
+
+def test_lite_seeded_fit_is_independent_of_workers():
+    fit_vectorized=lite().calc_def_balloon_lite(seed=0)
+    fit_workers=lite().calc_def_balloon_lite(seed=0, workers=map)
+    assert fit_vectorized==fit_workers
+
+
+def test_lite_default_fit_keeps_immediate_updating(monkeypatch):
+    import scipy.optimize
+    calls=[]
+    differential_evolution=scipy.optimize.differential_evolution
+    def spy(*args, **kwargs):
+        calls.append(kwargs)
+        return differential_evolution(*args, **kwargs)
+    monkeypatch.setattr(scipy.optimize, 'differential_evolution', spy)
+    lite().calc_def_balloon_lite()
+    lite().calc_def_balloon_lite(seed=0)
+    assert 'updating' not in calls[0] and 'vectorized' not in calls[0]
+    assert calls[1]['updating']=='deferred' and calls[1]['vectorized']
+
+
+def test_batch_fit_matches_per_curve_fits():
+    from spirolib import spiro_features_extraction
+    signals=[]
+    fits=[]
+    for seed, (wn, zeta) in enumerate([(1.1,2.2), (0.7,3.5), (2.0,1.6)]):
+        signal=balloon_FE(fs=50, wn=wn, zeta=zeta, noise=0.02, seed=seed, duration=6+seed)
+        db=spiro_features_extraction.deflating_baloon(*signal)
+        db.run_model("", seed=0)
+        fits.append((db.wn, db.zeta, db.cost))
+        signals.append(signal)
+    batch=spiro_features_extraction.deflating_baloon_batch(signals)
+    batch.run_model(seed=0)
+    wn, zeta, cost=np.array(fits).T
+    np.testing.assert_allclose(batch.cost, cost, rtol=1e-8)
+    # the cost is flat near the minimum, so the parameters agree a little less tightly
+    np.testing.assert_allclose(batch.wn, wn, rtol=1e-6)
+    np.testing.assert_allclose(batch.zeta, zeta, rtol=1e-6)
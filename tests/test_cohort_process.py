@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+The process-pool cohort runner against a single-process run
+"""
+
+import numpy as np
+
+from spirolib import spiro_cohort_process
+from synthetic import balloon_FE
+
+
+def synthetic_cohort():
+    FVLData={'P'+str(i):list(balloon_FE(wn=1+0.2*i, noise=0.01, seed=i)) for i in range(3)}
+    # a recording that makes the processing raise
+    FVLData['broken']=None
+    return FVLData
+
+
+def test_cohort_results_do_not_depend_on_workers():
+    FVLData=synthetic_cohort()
+    results=[spiro_cohort_process(FVLData).run(n_workers=n_workers, chunksize=1, features=('AC','balloon'))
+             for n_workers in [1, 2]]
+    assert results[0]==results[1]
+    assert list(results[0])==list(FVLData)
+
+
+def test_cohort_records_errors_without_aborting():
+    results=spiro_cohort_process(synthetic_cohort()).run(n_workers=1, features=('AC','balloon'))
+    assert results['broken']['error'] is not None
+    assert 'Traceback' in results['broken']['traceback']
+    for patID in ['P0', 'P1', 'P2']:
+        assert results[patID]['error'] is None
+        assert results[patID]['accepted']
+        assert np.isfinite(results[patID]['wn'])
+
+
+def test_cohort_sends_priors_not_the_history(monkeypatch):
+    from spirolib import fit_history
+    jobs=[]
+    process_patient=spiro_cohort_process.process_patient
+    def spy(job):
+        jobs.append(job)
+        return process_patient(job)
+    monkeypatch.setattr(spiro_cohort_process, 'process_patient', staticmethod(spy))
+    history=fit_history()
+    history.add('P1', 1.2, 2.0)
+    cohort=spiro_cohort_process(synthetic_cohort())
+    results=cohort.run(n_workers=1, features=('balloon',), balloon_kwargs={'history':history, 'seed':0})
+    for patID, data, clinical, settings, seed, prior in jobs:
+        assert 'history' not in settings['balloon_kwargs']
+        assert prior==((1.2, 2.0) if patID=='P1' else None)
+    for patID in ['P0', 'P1', 'P2']:
+        assert history.get(patID)==(results[patID]['wn'], results[patID]['zeta'])
+    assert history.get('broken') is None
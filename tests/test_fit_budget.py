@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation budgets of differential evolution fits
+"""
+
+from spirolib import spiro_features_extraction, spiro_features_lite, utilities
+from synthetic import balloon_FE
+
+
+def count_evaluations(monkeypatch):
+    # counts the candidates scored by utilities.calc_balloon_cost
+    counter=[0]
+    calc_balloon_cost=utilities.calc_balloon_cost
+    def counting(self, params, *args, **kwargs):
+        J=calc_balloon_cost(self, params, *args, **kwargs)
+        counter[0]+=len(J)
+        return J
+    monkeypatch.setattr(utilities, 'calc_balloon_cost', counting)
+    return counter
+
+
+def test_max_nfev_counts_candidates_on_every_path(monkeypatch):
+    counter=count_evaluations(monkeypatch)
+    population=30 # popsize 15 x 2 parameters
+    for workers in [1, map]:
+        counter[0]=0
+        time, volume, flow=balloon_FE(noise=0.05)
+        db=spiro_features_extraction.deflating_baloon(time, volume, flow)
+        db.run_model("", seed=0, workers=workers, max_nfev=300)
+        assert not db.converged
+        # checked after every generation
+        assert 300<=counter[0]<=300+population
+        assert db.nfev==counter[0]
+
+
+def test_reported_nfev_counts_candidates(monkeypatch):
+    counter=count_evaluations(monkeypatch)
+    time, volume, flow=balloon_FE(noise=0.05)
+    db=spiro_features_extraction.deflating_baloon(time, volume, flow)
+    db.run_model("", seed=0, coarse_to_fine=True, max_nfev=10**6)
+    # the least-squares refinement does not use calc_balloon_cost
+    assert db.nfev>=counter[0]>0
+
+
+def test_lite_max_nfev_matches_workers(monkeypatch):
+    counter=count_evaluations(monkeypatch)
+    counts=[]
+    for workers in [1, map]:
+        counter[0]=0
+        sl=spiro_features_lite()
+        sl.time_us, sl.volume_us, sl.flow_us=balloon_FE(fs=10, noise=0.05)
+        sl.calc_def_balloon_lite(seed=0, workers=workers, max_nfev=200)
+        assert not sl.balloon_converged
+        counts.append(counter[0])
+    assert counts[0]==counts[1]
+    assert 200<=counts[0]<=230
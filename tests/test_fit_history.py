@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-started deflating balloon fits from a per-patient fit_history
+"""
+
+import pytest
+
+from spirolib import fit_history, spiro_features_extraction
+from synthetic import balloon_FE
+
+
+def test_history_warm_starts_the_next_fit(tmp_path):
+    history=fit_history(str(tmp_path/'fits.p'))
+    fits=[]
+    for seed in [0, 1]:
+        time, volume, flow=balloon_FE(noise=0.02, seed=seed)
+        db=spiro_features_extraction.deflating_baloon(time, volume, flow)
+        db.run_model("", seed=0, history=history, patientID='P1')
+        fits.append(db)
+    assert not fits[0].warm_started
+    assert fits[1].warm_started
+    assert fits[1].nfev<fits[0].nfev
+    history.save()
+    assert fit_history(str(tmp_path/'fits.p')).get('P1')==(fits[1].wn, fits[1].zeta)
+
+
+def test_history_requires_patientID():
+    time, volume, flow=balloon_FE()
+    db=spiro_features_extraction.deflating_baloon(time, volume, flow)
+    with pytest.raises(Exception, match='patientID'):
+        db.run_model("", history=fit_history())
+
+
+def test_far_prior_falls_back_to_full_search():
+    fits=[]
+    for prior in [None, (2.9, 5.9)]:
+        db=spiro_features_extraction.deflating_baloon(*balloon_FE(noise=0.02))
+        db.run_model("", seed=0, prior=prior)
+        fits.append(db)
+    assert not fits[1].warm_started
+    assert fits[1].nfev>fits[0].nfev
+    assert fits[1].cost==pytest.approx(fits[0].cost, rel=1e-6)
+
+
+def test_prior_fit_is_rejected_when_poor():
+    db=spiro_features_extraction.deflating_baloon(*balloon_FE(noise=0.02))
+    db.run_model("", seed=0)
+    assert db.fit_from_prior((db.wn, db.zeta))[4]
+    # no inner box edge here, only the quality check can reject the fit
+    bounds=[(2,3), (4,6)]
+    assert not db.fit_from_prior((2.5, 5), bounds=bounds, narrow=1.0)[4]
+    assert db.fit_from_prior((2.5, 5), bounds=bounds, narrow=1.0, max_rel_cost=1.0)[4]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+FEF percentiles and time offsets against the original sample by sample loops
+"""
+
+import numpy as np
+import pytest
+
+from spirolib import spiro_signal_process
+from synthetic import balloon_FE
+
+
+def calc_flow_parameters_loop(FEvol, FEflow, FEtime):
+    # original implementation of calc_flow_parameters
+    norm_c=FEvol[-1]
+    FEvol_norm=FEvol/norm_c
+    PEF=FEflow[np.argmax(FEflow)]
+    indx=0
+    while FEvol_norm[indx]<=1:
+        if FEvol_norm[indx+1]>=0.25 and FEvol_norm[indx]<0.25:
+            FEF25=np.interp(0.25,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEflow[indx],FEflow[indx+1]])
+            time25=np.interp(0.25,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEtime[indx],FEtime[indx+1]])
+        if FEvol_norm[indx+1]>=0.5 and FEvol_norm[indx]<0.5:
+            FEF50=np.interp(0.5,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEflow[indx],FEflow[indx+1]])
+        if FEvol_norm[indx+1]>=0.75 and FEvol_norm[indx]<0.75:
+            FEF75=np.interp(0.75,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEflow[indx],FEflow[indx+1]])
+            time75=np.interp(0.75,[FEvol_norm[indx],FEvol_norm[indx+1]],[FEtime[indx],FEtime[indx+1]])
+            break
+        indx+=1
+    FEF_25_75=(0.5*norm_c)/(time75-time25)
+    return round(PEF,2), round(FEF25,2), round(FEF50,2), round(FEF75,2), round(FEF_25_75,2)
+
+
+def get_Indexes_In_1s_loop(time, start_index=0):
+    # original implementation of get_Indexes_In_1s
+    time=time[start_index:]
+    time=time-time[0]
+    new_list = list(time-1)
+    indexes_1s = next(t[0] for t in enumerate(new_list) if t[1] > 0)
+    return indexes_1s - 1
+
+
+def random_FE(rng):
+    time, volume, flow=balloon_FE(fs=rng.choice([10,50,100]), wn=rng.uniform(0.5,2), zeta=rng.uniform(1.2,4),
+                                  noise=rng.choice([0,0.05]), seed=rng.integers(1000))
+    if rng.random()<0.5:
+        # non-monotone volume
+        volume=volume+rng.normal(0,0.01,len(volume))
+    if rng.random()<0.3:
+        # irregular sampling
+        time=np.cumsum(rng.uniform(0.5,1.5,len(time)))*(time[1]-time[0])
+    return time, volume, flow
+
+
+def test_flow_parameters_match_loop():
+    rng=np.random.default_rng(0)
+    for _ in range(200):
+        time, volume, flow=random_FE(rng)
+        sp=spiro_signal_process(time, volume, flow, 'P', 1, True)
+        assert sp.calc_flow_parameters()==calc_flow_parameters_loop(volume, flow, time)
+
+
+def test_time_offsets_match_loop():
+    rng=np.random.default_rng(1)
+    for _ in range(200):
+        time, volume, flow=random_FE(rng)
+        sp=spiro_signal_process(time, volume, flow, 'P', 1, True)
+        for start_index in rng.integers(0, len(time)//2, 5):
+            assert sp.get_Indexes_In_1s(start_index)==get_Indexes_In_1s_loop(time, start_index)
+
+
+def test_short_signal_has_no_1s_index():
+    time, volume, flow=balloon_FE(duration=0.8)
+    sp=spiro_signal_process(time, volume, flow, 'P', 1, True)
+    assert sp.get_Indexes_In_1s()==-1
+
+
+def test_short_signal_raises_in_FEV1():
+    time, volume, flow=balloon_FE(duration=0.8)
+    sp=spiro_signal_process(time, volume, flow, 'P', 1, True)
+    sp.index1, sp.index2=0, len(time)-1
+    with pytest.raises(Exception, match='shorter than 1 s'):
+        sp.calc_FEV1_FVC()
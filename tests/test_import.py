@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Import-time budget of the package and lazy loading of submodules and heavy dependencies
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cumulative time of "import spirolib" as reported by python -X importtime (about 2 ms here,
+# matplotlib alone takes hundreds of ms)
+IMPORT_BUDGET_MS=100
+
+HEAVY_MODULES=['matplotlib', 'peakutils', 'scipy.optimize', 'sklearn']
+
+
+def run_python(*args):
+    # fresh interpreter, so that nothing is imported beforehand
+    env=dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable]+list(args), capture_output=True, text=True, env=env, check=True, cwd=ROOT)
+
+
+def test_import_time_budget():
+    stderr=run_python('-X', 'importtime', '-c', 'import spirolib').stderr
+    lines=[line for line in stderr.splitlines() if line.split('|')[-1].strip()=='spirolib']
+    assert len(lines)==1
+    cumulative_ms=int(lines[0].split('|')[1])/1000
+    assert cumulative_ms<IMPORT_BUDGET_MS
+
+
+def test_no_heavy_dependencies_at_import():
+    code=('import sys, spirolib\n'
+          'print(",".join(m for m in ' + repr(HEAVY_MODULES) + ' if m in sys.modules))')
+    assert run_python('-c', code).stdout.strip()==''
+
+
+def test_lazy_attributes_resolve():
+    code=('import sys, inspect, spirolib\n'
+          'assert inspect.isclass(spirolib.spiro_signal_process)\n'
+          'assert inspect.isclass(spirolib.utilities)\n'
+          'assert inspect.isclass(spirolib.spiro_features_extraction.deflating_baloon)\n'
+          'assert spirolib.spiro_signal_process.__name__ in dir(spirolib)\n'
+          'print(",".join(m for m in ' + repr(HEAVY_MODULES) + ' if m in sys.modules))')
+    assert run_python('-c', code).stdout.strip()==''
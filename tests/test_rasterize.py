@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Rasterized grayscale images of flow-volume and volume-time curves
+"""
+
+import numpy as np
+import pytest
+
+from spirolib import utilities
+from synthetic import balloon_FE
+
+
+def curves(n=5):
+    result=[]
+    for seed in range(n):
+        time, volume, flow=balloon_FE(fs=50, FVC=3+0.3*seed, seed=seed)
+        result.append((volume, flow))
+    return result
+
+
+def dark_box(image):
+    # first and last row and column with a dark pixel
+    rows=np.flatnonzero(image.min(axis=1)<128)
+    cols=np.flatnonzero(image.min(axis=0)<128)
+    return rows[0], rows[-1], cols[0], cols[-1]
+
+
+def test_shape_and_dtype():
+    ut=utilities()
+    images=ut.rasterize_curves(curves(), size=40)
+    assert images.shape==(5,40,40) and images.dtype==np.uint8
+    assert images.max()==255 and images.min()<64
+    images_float=ut.rasterize_curves(curves(), size=40, dtype='float32')
+    assert images_float.dtype==np.float32
+    assert 0<=images_float.min() and images_float.max()<=1
+    np.testing.assert_array_equal(np.rint(255*images_float), images)
+    np.testing.assert_array_equal(ut.convert2grayscale(*curves()[2], size=40), images[2])
+
+
+def test_axis_mapping():
+    # a straight line from (0,0) to (4,2)
+    ut=utilities()
+    line=(np.linspace(0,4,50), np.linspace(0,2,50))
+    size=64
+    for mode in ['FVL', 'VT']:
+        image=ut.rasterize_curves([line], mode=mode, size=size)[0]
+        left, bottom, width, height, x_lo, x_len, y_lo, y_len=ut.get_plot_area(0, 4, 0, 2, mode)
+        col=size*(left+width*(np.array([0,4])-x_lo)/x_len)
+        row=size*(1-bottom-height*(np.array([0,2])-y_lo)/y_len)
+        top, low, first, last=dark_box(image)
+        assert abs(first-col[0])<=2 and abs(last-col[1])<=2
+        assert abs(top-row[1])<=2 and abs(low-row[0])<=2
+        # rows run from the top, so the start of the line is at the bottom left
+        assert image[low, first]<128 and image[top, last]<128
+    # one flow unit is displayed half as long as one volume unit in FVL mode
+    FVL=dark_box(ut.rasterize_curves([line], mode='FVL', size=size)[0])
+    VT=dark_box(ut.rasterize_curves([line], mode='VT', size=size)[0])
+    assert FVL[1]-FVL[0]<(VT[1]-VT[0])/2
+    assert FVL[3]-FVL[2]>=VT[3]-VT[2]-2
+
+
+def test_out_array_and_memmap(tmp_path):
+    ut=utilities()
+    expected=ut.rasterize_curves(curves())
+    out=np.zeros((5,32,32), dtype=np.uint8)
+    assert ut.rasterize_curves(curves(), out=out, chunk=2) is out
+    np.testing.assert_array_equal(out, expected)
+    path=str(tmp_path/'images.npy')
+    images=ut.rasterize_curves(curves(), out=path, chunk=3)
+    assert isinstance(images, np.memmap)
+    images.flush()
+    np.testing.assert_array_equal(np.load(path), expected)
+
+
+def test_empty_curves_are_blank():
+    ut=utilities()
+    data=curves(3)
+    images=ut.rasterize_curves([([],[]), data[0], ([],[]), data[1], ([1.0],[2.0]), data[2]], chunk=4)
+    for i in [0, 2, 4]:
+        assert (images[i]==255).all()
+    np.testing.assert_array_equal(images[[1,3,5]], ut.rasterize_curves(data))
+    assert (ut.rasterize_curves([([],[])])==255).all()
+    with pytest.raises(Exception, match='do not match'):
+        ut.rasterize_curves([(np.zeros(3), np.zeros(4))])
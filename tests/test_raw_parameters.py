@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Raw spirometry parameter columns of spiro_batch_process
+"""
+
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from spirolib import spiro_batch_process
+
+PARAMS=['FEV1', 'FVC', 'Tiff', 'PEF', 'FEF25', 'FEF50', 'FEF75', 'FEF25_75']
+
+
+def best_trial(rng, with_pred=True):
+    attrs={param:round(rng.uniform(1,8),2) for param in PARAMS}
+    if with_pred:
+        attrs.update({param+'_PerPred':rng.uniform(60,120) for param in PARAMS})
+    return types.SimpleNamespace(**attrs)
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_raw_parameters(dtype, capsys):
+    rng=np.random.default_rng(0)
+    df_main=pd.DataFrame({'age':[30, 40, 50, 60]}, index=['P0', 'P1', 'P2', 'P3'])
+    BestFVL={'P0':best_trial(rng), 'P1':best_trial(rng, with_pred=False), 'P3':best_trial(rng),
+             'X1':best_trial(rng), 'X2':best_trial(rng)}
+    df=spiro_batch_process(df_main, BestFVL, 'pre_').update_raw_parameters(dtype=dtype)
+
+    assert list(df_main.columns)==['age']
+    assert list(df.index)==['P0', 'P1', 'P2', 'P3']
+    assert (df['age']==df_main['age']).all()
+    out=capsys.readouterr().out
+    assert out.count("WARNING")==1
+    assert "2 raw data IDs not found in dataset: X1, X2" in out
+
+    for param in PARAMS:
+        name='FEV1_FVC' if param=='Tiff' else param
+        for suffix in ['', '_PerPred']:
+            col=df['pre_'+name+suffix+'_raw']
+            assert col.dtype==np.dtype(dtype)
+            for patID in ['P0', 'P1', 'P3']:
+                expected=getattr(BestFVL[patID], param+suffix, np.nan)
+                np.testing.assert_equal(col[patID], np.array(expected, dtype=dtype))
+            assert np.isnan(col['P2'])
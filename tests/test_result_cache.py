@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Deflating balloon fits restored from a result_cache
+"""
+
+import numpy as np
+
+from spirolib import fit_history, result_cache, spiro_features_extraction
+from synthetic import balloon_FE
+
+
+def cached_fit(cache, **kwargs):
+    db=spiro_features_extraction.deflating_baloon(*balloon_FE(noise=0.02))
+    db.run_model("", seed=0, cache=cache, **kwargs)
+    return db
+
+
+def no_search(*args, **kwargs):
+    raise AssertionError('differential_evolution called on a cache hit')
+
+
+def test_cache_hit_restores_fit_and_model(tmp_path, monkeypatch):
+    import scipy.optimize
+    cache=result_cache(str(tmp_path/'cache'))
+    fit=cached_fit(cache)
+    monkeypatch.setattr(scipy.optimize, 'differential_evolution', no_search)
+    restored=cached_fit(cache)
+    for attr in ['wn', 'zeta', 'cost', 'nfev', 'converged', 'warm_started',
+                 'mse_volume', 'mse_flow', 'R2_volume', 'R2_flow']:
+        assert getattr(restored, attr)==getattr(fit, attr), attr
+    np.testing.assert_array_equal(restored.model_volume, fit.model_volume)
+    np.testing.assert_array_equal(restored.model_flow, fit.model_flow)
+    # only the fit outputs are stored, not the signals
+    (entry, size, _),=cache.scan()
+    assert size<1000
+
+
+def test_cache_hit_updates_history(tmp_path, monkeypatch):
+    import scipy.optimize
+    cache=result_cache(str(tmp_path/'cache'))
+    fit=cached_fit(cache)
+    monkeypatch.setattr(scipy.optimize, 'differential_evolution', no_search)
+    history=fit_history()
+    cached_fit(cache, history=history, patientID='P1')
+    assert history.get('P1')==(fit.wn, fit.zeta)
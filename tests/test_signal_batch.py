@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+spiro_signal_batch against per-object spiro_signal_process
+"""
+
+import copy
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from spirolib import spiro_signal_batch, spiro_signal_process, spiro_signal_store
+from synthetic import balloon_FE, full_manoeuvre
+
+
+def random_signals(rng, n=40):
+    signals=[]
+    for i in range(n):
+        kwargs=dict(fs=int(rng.choice([50,100])), wn=rng.uniform(0.6,2), zeta=rng.uniform(1.3,4),
+                    FVC=rng.uniform(2,5), noise=rng.choice([0,0.02]), seed=i)
+        if i%2:
+            sp=spiro_signal_process(*balloon_FE(**kwargs), 'P'+str(i//4), i%4, True)
+        else:
+            sp=spiro_signal_process(*full_manoeuvre(**kwargs), 'P'+str(i//4), i%4, False)
+        sp.index1, sp.index2=sp.get_FE_start_end(start_type="BEV")
+        signals.append(sp)
+    return signals
+
+
+def test_finalize_signals_matches_finalize_signal():
+    rng=np.random.default_rng(0)
+    signals=random_signals(rng)
+    sex, age, height=rng.integers(0,2,len(signals)), rng.uniform(20,80,len(signals)), rng.uniform(150,195,len(signals))
+    batch=spiro_signal_batch(copy.deepcopy(signals))
+    cols=batch.finalize_signals(sex=sex, age=age, height=height)
+    for i, sp in enumerate(signals):
+        sp.finalize_signal(sex=sex[i], age=age[i], height=height[i])
+        assert batch.signal_finalized[i]
+        for col in ['FEV1', 'FVC', 'Tiff', 'PEF', 'FEF25', 'FEF50', 'FEF75', 'FEF25_75',
+                    'FEV1_PerPred', 'FVC_PerPred', 'PEF_PerPred', 'FEF25_75_PerPred']:
+            assert cols[col][i]==getattr(sp, col), (i, col)
+        np.testing.assert_array_equal(batch.get_curve(i)[1], sp.volume)
+
+
+def test_finalize_signals_keeps_earlier_views():
+    signals=random_signals(np.random.default_rng(1), n=4)
+    batch=spiro_signal_batch(signals)
+    sp=batch.get_signal(0)
+    segmentation=sp.get_FE_start_end(start_type="BEV")
+    volume=sp.volume.copy()
+    batch.finalize_signals()
+    np.testing.assert_array_equal(sp.volume, volume)
+    assert sp.get_FE_start_end(start_type="BEV")==segmentation
+    np.testing.assert_array_equal(batch.get_signal(0).volume, volume-volume[batch.index1[0]])
+
+
+def assert_batches_equal(batch, expected):
+    for name in ['time', 'volume', 'flow', 'offsets', 'index1', 'index2',
+                 'flag_given_signal_is_FE', 'signal_finalized']:
+        np.testing.assert_array_equal(getattr(batch, name), getattr(expected, name))
+    assert [str(x) for x in batch.patientID]==[str(x) for x in expected.patientID]
+    assert [str(x) for x in batch.trialID]==[str(x) for x in expected.trialID]
+    for col in expected.columns:
+        np.testing.assert_array_equal(batch.columns[col], expected.columns[col])
+
+
+def test_store_round_trip(tmp_path):
+    batch=spiro_signal_batch(random_signals(np.random.default_rng(2)))
+    batch.finalize_signals()
+    store=spiro_signal_store(str(tmp_path/'store'))
+    store.write(batch)
+    assert_batches_equal(store.read(), batch)
+    assert_batches_equal(spiro_signal_store(str(tmp_path/'store')).read(mmap_mode=None), batch)
+
+
+def test_store_overwrite_replaces_whole_store(tmp_path):
+    path=str(tmp_path/'store')
+    first=spiro_signal_batch(random_signals(np.random.default_rng(3), n=8))
+    second=spiro_signal_batch(random_signals(np.random.default_rng(4), n=12))
+    spiro_signal_store(path).write(first)
+    old=spiro_signal_store(path).read()
+    spiro_signal_store(path).write(second)
+    assert_batches_equal(spiro_signal_store(path).read(), second)
+    # arrays mapped before the write still show the old store
+    assert_batches_equal(old, first)
+    assert os.listdir(tmp_path)==['store']
+
+
+def test_store_get_indexes(tmp_path):
+    signals=random_signals(np.random.default_rng(5))
+    store=spiro_signal_store(str(tmp_path/'store'))
+    store.write(spiro_signal_batch(signals))
+    patientIDs=np.array([sp.patientID for sp in signals])
+    for patID in np.unique(patientIDs):
+        indexes=store.get_indexes(patID)
+        np.testing.assert_array_equal(indexes, np.flatnonzero(patientIDs==patID))
+        for i, sp in zip(indexes, store.get_signals(patID)):
+            np.testing.assert_array_equal(sp.volume, signals[i].volume)
+    assert len(store.get_indexes('unknown'))==0
+
+
+def test_store_read_is_memory_mapped_and_read_only(tmp_path):
+    batch=spiro_signal_batch(random_signals(np.random.default_rng(6), n=4))
+    store=spiro_signal_store(str(tmp_path/'store'))
+    store.write(batch)
+    stored=store.read()
+    assert isinstance(stored.volume, np.memmap)
+    assert not stored.volume.flags.writeable
+    with pytest.raises(ValueError):
+        stored.volume[0]=1.0
+    # copy-on-write changes stay in memory
+    stored=spiro_signal_store(str(tmp_path/'store')).read(mmap_mode='c')
+    stored.volume[0]=batch.volume[0]+1
+    np.testing.assert_array_equal(spiro_signal_store(str(tmp_path/'store')).read().volume, batch.volume)
+
+
+def test_store_pickle_import_export(tmp_path):
+    rng=np.random.default_rng(7)
+    signals=random_signals(rng, n=6)
+    for i, sp in enumerate(signals):
+        sp.patientID='P'+str(i)
+    FVLData={sp.patientID:sp for sp in signals}
+    with open(tmp_path/'FVLData.pkl', 'wb') as f:
+        pickle.dump(FVLData, f)
+    store=spiro_signal_store(str(tmp_path/'store'))
+    store.import_pickle(str(tmp_path/'FVLData.pkl'))
+    assert_batches_equal(store.read(), spiro_signal_batch(FVLData))
+
+    store.export_pickle(str(tmp_path/'exported.pkl'))
+    with open(tmp_path/'exported.pkl', 'rb') as f:
+        exported=pickle.load(f)
+    assert list(exported)==list(FVLData)
+    for patID, sp in exported.items():
+        assert not isinstance(sp.volume, np.memmap)
+        for name in ['time', 'volume', 'flow']:
+            np.testing.assert_array_equal(getattr(sp, name), getattr(FVLData[patID], name))
+        assert (sp.index1, sp.index2)==(FVLData[patID].index1, FVLData[patID].index2)
+
+    store.write(spiro_signal_batch(random_signals(rng, n=4)))
+    with pytest.raises(Exception, match='more than one curve'):
+        store.export_pickle(str(tmp_path/'exported.pkl'))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized parameter sweeps of the deflating balloon model against the per-point model
+"""
+
+import numpy as np
+import pytest
+
+from spirolib import spiro_features_extraction
+from synthetic import balloon_FE
+
+
+def fitted_balloon(**kwargs):
+    db=spiro_features_extraction.deflating_baloon(*balloon_FE(noise=0.02, **kwargs))
+    db.run_model("", seed=0)
+    return db
+
+
+def model_at(db, wn, zeta):
+    # model curves and FEV1, FVC as run_model and calc_FEV1_FVC compute them
+    db.model_volume, db.model_flow=db.calc_hypothesis([wn, zeta])
+    db.reorient_model()
+    FEV1, FVC=db.calc_FEV1_FVC()
+    return db.model_volume, db.model_flow, FEV1, FVC
+
+
+@pytest.mark.parametrize("fs", [100, 30])
+def test_sweep_matches_model(fs):
+    db=fitted_balloon(fs=fs)
+    wn, zeta=np.meshgrid([0.4, db.wn, 2.7], [1.2, db.zeta, 5.5])
+    sweep=db.run_sweep(wn, zeta, return_curves=True)
+    unrounded=db.run_sweep(wn, zeta, decimals=None)
+    for i in np.ndindex(wn.shape):
+        model_volume, model_flow, FEV1, FVC=model_at(db, wn[i], zeta[i])
+        np.testing.assert_allclose(sweep['model_volume'][i], model_volume, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(sweep['model_flow'][i], model_flow, rtol=1e-12, atol=1e-12)
+        assert (sweep['FEV1'][i], sweep['FVC'][i])==(FEV1, FVC)
+        np.testing.assert_allclose(unrounded['FVC'][i], abs(model_volume[-1]), rtol=1e-12)
+
+
+def test_sweep_defaults_to_fitted_parameters():
+    db=fitted_balloon()
+    sweep=db.run_sweep()
+    assert sweep['FEV1'].shape==()
+    assert (sweep['FEV1'], sweep['FVC'])==model_at(db, db.wn, db.zeta)[2:]
+
+
+def test_sweep_rejects_other_excitations():
+    db=spiro_features_extraction.deflating_baloon(*balloon_FE(noise=0.02))
+    db.run_model("Linear", seed=0, maxiter=3)
+    with pytest.raises(Exception, match='default excitation only'):
+        db.run_sweep()
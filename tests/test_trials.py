@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Cohort-wide and incremental trial selection against the per-patient spiro_trialsbatch_process
+"""
+
+import types
+
+import numpy as np
+import pandas as pd
+
+from spirolib import spiro_cohort_trials_process, spiro_trial_bank, spiro_trialsbatch_process
+
+
+def random_trials(rng, n_trials):
+    # FEV1 and FVC rounded as finalize_signal does, so that ties occur
+    return {'T'+str(j):types.SimpleNamespace(FEV1=round(rng.uniform(2,3),1), FVC=round(rng.uniform(3,3.6),1))
+            for j in range(n_trials)}
+
+
+def test_cohort_trials_match_trialsbatch():
+    rng=np.random.default_rng(0)
+    sessions={(str(p), s):random_trials(rng, rng.integers(1,5)) for p in range(300) for s in ['pre','post']}
+    rows=[(p, s, trialID, sp.FEV1, sp.FVC) for (p, s), trials in sessions.items() for trialID, sp in trials.items()]
+    df=pd.DataFrame(rows, columns=['patientID', 'session', 'trialID', 'FEV1', 'FVC'])
+    # trials of a session are not contiguous in the table
+    df=df.sample(frac=1, random_state=0)
+    sessions={key:{row.trialID:types.SimpleNamespace(FEV1=row.FEV1, FVC=row.FVC) for row in group.itertuples()}
+              for key, group in df.groupby(['patientID', 'session'], sort=False)}
+    
+    cohort=spiro_cohort_trials_process(df, session_col='session')
+    for tolerance in [0.1, 0.2]:
+        repeatable=cohort.check_between_manoeuvre_criteria(tolerance)['repeatable']
+        for key, trials in sessions.items():
+            expected=spiro_trialsbatch_process(trials).check_between_manoeuvre_criteria(tolerance)
+            if expected=="Only 1 trial found":
+                assert repeatable[key] is pd.NA
+            else:
+                assert repeatable[key]==expected
+    best=cohort.select_best_trial()
+    for key, trials in sessions.items():
+        assert best[key]==spiro_trialsbatch_process(trials).select_best_trial()
+
+
+def test_trial_bank_matches_trialsbatch():
+    rng=np.random.default_rng(1)
+    for _ in range(300):
+        bank=spiro_trial_bank()
+        trials={}
+        for _ in range(12):
+            # add, replace or remove a trial
+            trialID='T'+str(rng.integers(0,6))
+            if trialID in trials and rng.random()<0.4:
+                bank.remove_trial(trialID)
+                del trials[trialID]
+            else:
+                sp=random_trials(rng, 1)['T0']
+                bank.add_trial(trialID, sp)
+                trials[trialID]=sp
+            if len(trials)==0:
+                continue
+            batch=spiro_trialsbatch_process(trials)
+            assert bank.check_between_manoeuvre_criteria(0.2)==batch.check_between_manoeuvre_criteria(0.2)
+            assert bank.select_best_trial()==batch.select_best_trial()